@@ -0,0 +1,50 @@
+"""
+Throughput of spec parsing and the spec/url codec for typical preset strings.
+
+    python benchmarks/bench_spec.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simplethumb.spec import Spec, LittleFloat, decode_spec, encode_spec  # noqa: E402
+
+SPECS = [
+    '80x80,C',
+    '320x240',
+    '100x',
+    'x400 jpg',
+    'C16:9 1200x jpeg80',
+    '50% pngO',
+]
+NUMBER = 20000
+
+
+def rate(func):
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    return NUMBER / seconds
+
+
+def main():
+    print('{:<22} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'spec', 'parse/s', 'encode/s', 'decode/s', 'url enc/s', 'url dec/s'))
+    for spec_string in SPECS:
+        spec = Spec.from_string(spec_string)
+        encoded = spec.encode()
+        url_spec = encode_spec(encoded, 'images/foo.jpg', 1234567890, 'KEY')
+        print('{:<22} {:>12.0f} {:>12.0f} {:>12.0f} {:>12.0f} {:>12.0f}'.format(
+            spec_string,
+            rate(lambda: Spec.from_string(spec_string)),
+            rate(spec.encode),
+            rate(lambda: Spec.from_spec(encoded)),
+            rate(lambda: encode_spec(encoded, 'images/foo.jpg', 1234567890, 'KEY')),
+            rate(lambda: decode_spec(url_spec, 'images/foo.jpg', 1234567890, 'KEY')),
+        ))
+    print('LittleFloat pack/s {:.0f}, unpack/s {:.0f}'.format(
+        rate(lambda: LittleFloat.pack(16 / 9.0)), rate(lambda: LittleFloat.unpack(2672))))
+
+
+if __name__ == '__main__':
+    main()
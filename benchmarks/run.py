@@ -0,0 +1,264 @@
+"""
+Benchmarks for the whole thumbnail pipeline.
+
+    python benchmarks/run.py [--quick] [--output results.json] [--compare baseline.json]
+
+Covers spec parsing, the url codec, the template tag, Image.process_image
+(plus encoding) for each filter in Image.PROCESS_ORDER on synthetic JPEG and PNG sources
+of several sizes, and serve_image through the Django test client with a
+cold and a warm cache. Reports latency percentiles, throughput and how
+far each case raised the resident set size above where it started, and
+optionally writes them as JSON so runs can be compared across versions.
+"""
+from __future__ import division, print_function
+
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.cache import caches  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.test.utils import setup_test_environment  # noqa: E402
+from PIL import Image as PilImage  # noqa: E402
+
+from simplethumb.conf import settings  # noqa: E402
+from simplethumb.models import Image  # noqa: E402
+from simplethumb.spec import Spec, decode_spec, encode_spec  # noqa: E402
+from simplethumb.templatetags.simplethumb_tags import simplethumb  # noqa: E402
+
+SOURCE_SIZES = OrderedDict([
+    ('small', (320, 240)),
+    ('medium', (1600, 1200)),
+    ('huge', (6000, 4000)),
+])
+SOURCE_FORMATS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+}
+# one spec exercising each filter in Image.PROCESS_ORDER
+FILTER_SPECS = {
+    Spec.TOKEN_CROP_RATIO: 'C16:9',
+    Spec.TOKEN_CROP: '200x200,C',
+    Spec.TOKEN_SCALE: '25%',
+    Spec.TOKEN_WIDTH: '400x',
+    Spec.TOKEN_HEIGHT: 'x300',
+    Spec.TOKEN_IMAGEFMT: 'png',
+}
+# smaller than the smallest source, so every source is resized rather than passed through
+SERVE_SPEC = '200x150 jpg'
+
+
+LIBC = ctypes.CDLL(ctypes.util.find_library('c')) if ctypes.util.find_library('c') else None
+
+
+def proc_status_mb(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                # in kB
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def start_rss():
+    """
+    Start watching the resident set size for one case. On linux memory
+    freed by earlier cases is given back and the peak is reset to the
+    current size, and the case's own peak is measured from there;
+    elsewhere the process-wide peak never comes down, so a case only
+    shows how far it raised it. Returns the starting point, in MB.
+    """
+    gc.collect()
+    if LIBC is not None and hasattr(LIBC, 'malloc_trim'):
+        # glibc keeps freed memory resident, where the next case would reuse it unseen
+        LIBC.malloc_trim(0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return proc_status_mb('VmRSS')
+    except (IOError, OSError, KeyError):
+        return peak_rss()
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process since the last start_rss() on
+    linux, otherwise since it started, in MB.
+    """
+    try:
+        return proc_status_mb('VmHWM')
+    except (IOError, OSError, KeyError):
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macOS
+        return usage / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def measure(func, iterations, setup=None):
+    rss_start = start_rss()
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    total = sum(timings)
+    return {
+        'iterations': iterations,
+        'p50_ms': percentile(timings, 0.5) * 1000,
+        'p90_ms': percentile(timings, 0.9) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'ops_per_sec': iterations / total if total else float('inf'),
+        'rss_increase_mb': max(peak_rss() - rss_start, 0),
+    }
+
+
+def make_sources(directory, sizes):
+    """
+    Write synthetic sources: gradients with noise, so that they compress
+    like photographs rather than flat colour.
+    """
+    names = []
+    for size_name in sizes:
+        width, height = SOURCE_SIZES[size_name]
+        red = PilImage.linear_gradient('L').resize((width, height))
+        green = PilImage.radial_gradient('L').resize((width, height))
+        blue = PilImage.effect_noise((width, height), 64)
+        im = PilImage.merge('RGB', (red, green, blue))
+        for image_format, ext in SOURCE_FORMATS.items():
+            name = 'bench-{}.{}'.format(size_name, ext)
+            im.save(os.path.join(directory, name), image_format)
+            names.append((size_name, image_format, name))
+    return names
+
+
+def process(name, spec_string):
+    # Pillow decodes lazily, so encode as well to be sure the pixels were actually processed
+    image = Image(url=name, spec=spec_string)
+    image.process_image()
+    image.engine.save(image.im, image.image_format, **image.save_params)
+
+
+def clear_cache():
+    caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+
+def run(args):
+    results = {}
+    scale = 0.2 if args.quick else 1.0
+
+    def iterations(count):
+        return max(int(count * scale), 3)
+
+    def record(name, result):
+        results[name] = result
+        print('{:<40} p50 {:>9.3f}ms  p90 {:>9.3f}ms  p99 {:>9.3f}ms  {:>10.1f} ops/s  {:>7.1f} MB'.format(
+            name, result['p50_ms'], result['p90_ms'], result['p99_ms'], result['ops_per_sec'],
+            result['rss_increase_mb']))
+
+    for spec_string in ('80x80,C', 'C16:9 1200x jpeg80'):
+        record('spec.from_string[{}]'.format(spec_string),
+               measure(lambda: Spec.from_string(spec_string), iterations(20000)))
+
+    encoded = Spec.from_string('C16:9 1200x jpeg80').encoded
+    url_spec = encode_spec(encoded, 'images/foo.jpg', 1234567890, 'KEY')
+    record('encode_spec', measure(lambda: encode_spec(encoded, 'images/foo.jpg', 1234567890, 'KEY'),
+                                  iterations(20000)))
+    record('decode_spec', measure(lambda: decode_spec(url_spec, 'images/foo.jpg', 1234567890, 'KEY'),
+                                  iterations(20000)))
+
+    source_dir = tempfile.mkdtemp()
+    sizes = ['small', 'medium'] if args.quick else list(SOURCE_SIZES)
+    try:
+        names = make_sources(source_dir, sizes)
+        with override_settings(STATICFILES_DIRS=list(settings.STATICFILES_DIRS) + [source_dir]):
+            name = names[0][2]
+            record('templatetag', measure(lambda: simplethumb(name, SERVE_SPEC), iterations(5000)))
+
+            # smallest sources first, so where the peak RSS can't be reset each case still shows its growth
+            for size_name, image_format, name in names:
+                for image_filter in Image.PROCESS_ORDER:
+                    spec_string = FILTER_SPECS[image_filter]
+                    count = 3 if size_name == 'huge' else iterations(20)
+                    record('process_image[{},{},{}]'.format(size_name, image_format, image_filter),
+                           measure(lambda: process(name, spec_string), count))
+
+            client = Client()
+            for size_name, image_format, name in names:
+                url = simplethumb(name, SERVE_SPEC)
+                count = 3 if size_name == 'huge' else iterations(20)
+                record('serve_image[{},{},cold]'.format(size_name, image_format),
+                       measure(lambda: client.get(url), count, setup=clear_cache))
+                client.get(url)
+                record('serve_image[{},{},warm]'.format(size_name, image_format),
+                       measure(lambda: client.get(url), iterations(200)))
+    finally:
+        shutil.rmtree(source_dir)
+        clear_cache()
+
+    return results
+
+
+def compare(results, baseline):
+    print()
+    print('{:<40} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline p50', 'p50', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['p50_ms'], result['p50_ms']
+        print('{:<40} {:>10.3f}ms {:>10.3f}ms {:>+7.1f}%'.format(name, old, new, (new - old) / old * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='fewer iterations, no huge sources')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    setup_test_environment()
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'engine': settings.SIMPLETHUMB_ENGINE,
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
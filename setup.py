@@ -14,7 +14,8 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     install_requires=['django', 'six', 'django-appconf', 'Pillow', ],
-    test_requires=['mock', ],
+    extras_require={'vips': ['pyvips', ], 'prometheus': ['prometheus_client', ], 'statsd': ['statsd', ]},
+    test_requires=['mock', 'hypothesis', ],
     include_package_data=True,
     classifiers=[
         'Environment :: Web Environment',
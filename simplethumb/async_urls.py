@@ -0,0 +1,10 @@
+from django.conf.urls import url
+from . import async_views
+
+
+urlpatterns = [
+    url(
+        r'^(?P<basename>.*)\.(?P<encoded_spec>[\w\-_]+)\.(?P<ext>\w{3,4})/?$',
+        async_views.serve_image,
+        name="simplethumb"),
+]
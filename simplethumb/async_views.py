@@ -0,0 +1,138 @@
+"""
+An asynchronous serve_image for ASGI deployments (Django 3.1+, python 3).
+
+Conditional requests and cache lookups run on the event loop; finding
+the source (which may ask SIMPLETHUMB_SOURCE_STORAGE about it), reading
+its header and fetching it run in a thread, and decoding, resizing and
+encoding in a bounded thread pool, so none of them hold up the loop. Once SIMPLETHUMB_RENDER_QUEUE_SIZE
+renders are waiting or running, further renders are answered with 503.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+
+from simplethumb import metrics
+from simplethumb.cache import Envelope, local_cache
+from simplethumb.conf import settings
+from simplethumb.models import image_cache
+from simplethumb.scheduler import RenderQueueTimeout
+from simplethumb.views import (envelope_response, file_response, finish_response, head_response,
+                               not_modified_response, prepare_image, rendered_response, stored_image_response,
+                               unavailable_response)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class RenderPool(object):
+    """
+    Runs renders in a thread pool of SIMPLETHUMB_RENDER_WORKERS threads.
+    Pillow and libvips release the GIL while they work on pixels.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self.pending = 0
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=settings.SIMPLETHUMB_RENDER_WORKERS)
+        return self._executor
+
+    async def run(self, func, *args):
+        # only touched from the event loop, so the counter needs no lock
+        if self.pending >= settings.SIMPLETHUMB_RENDER_QUEUE_SIZE:
+            raise PoolSaturated()
+        self.pending += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+
+render_pool = RenderPool()
+
+
+async def cache_get(key):
+    """
+    The Envelope cached under key, or None.
+    """
+    value = local_cache.get(key)
+    if value is not None:
+        metrics.incr('cache.local_hit')
+        return Envelope.unpack(value)
+    try:
+        value = await image_cache.aget(key)
+    except AttributeError:
+        # the async cache API arrived in Django 4.0
+        value = await sync_to_async(image_cache.get)(key)
+    envelope = Envelope.unpack(value)
+    if envelope is not None and not envelope.chunks:
+        local_cache.set(key, value)
+    metrics.incr('cache.hit' if envelope is not None else 'cache.miss')
+    return envelope
+
+
+def run_blocking(func, *args):
+    """
+    Run func in a thread rather than on the event loop, outside the render
+    pool: for work that may read the source or the cache, but doesn't render.
+    """
+    return sync_to_async(func, thread_sensitive=False)(*args)
+
+
+def passthrough_response(image, mimetype):
+    """
+    Respond with the source itself if the spec doesn't change it, otherwise
+    None. Reads the source's header, and may fetch the source from
+    SIMPLETHUMB_SOURCE_STORAGE.
+    """
+    if image.passthrough:
+        return file_response(image.path, mimetype)
+    return None
+
+
+# noinspection PyUnusedLocal
+async def serve_image(request, basename, encoded_spec, ext):
+    with metrics.in_progress('requests'), metrics.timer('request'):
+        return await _serve_image(request, basename, encoded_spec)
+
+
+async def _serve_image(request, basename, encoded_spec):
+    image, mimetype, negotiate = await run_blocking(prepare_image, request, basename, encoded_spec)
+
+    resp = not_modified_response(request, image, mimetype, negotiate)
+    if resp is not None:
+        return resp
+
+    if request.method == 'HEAD':
+        resp = await run_blocking(head_response, image, mimetype)
+        return finish_response(resp, image, negotiate)
+
+    try:
+        resp = await run_blocking(passthrough_response, image, mimetype)
+        if resp is not None:
+            metrics.incr('passthrough')
+        elif settings.SIMPLETHUMB_STORAGE_ROOT:
+            if await run_blocking(os.path.exists, image.stored_path):
+                resp = await run_blocking(stored_image_response, image, mimetype)
+            else:
+                resp = await render_pool.run(stored_image_response, image, mimetype)
+        else:
+            envelope = None
+            if settings.SIMPLETHUMB_CACHE_ENABLED:
+                envelope = await cache_get(image.cache_key)
+            if envelope is not None and not envelope.chunks:
+                resp = envelope_response(envelope)
+            else:
+                # not cached, or cached in chunks
+                resp = await render_pool.run(rendered_response, image, mimetype)
+    except (PoolSaturated, RenderQueueTimeout):
+        metrics.incr('unavailable')
+        return unavailable_response()
+
+    return finish_response(resp, image, negotiate)
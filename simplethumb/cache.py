@@ -0,0 +1,144 @@
+import json
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from simplethumb.conf import settings
+
+
+class Memo(dict):
+    """
+    A dict that empties itself once it holds max_entries items, for
+    memoizing cheap lookups without unbounded growth.
+    """
+
+    def __init__(self, max_entries=10000):
+        super(Memo, self).__init__()
+        self.max_entries = max_entries
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.max_entries and key not in self:
+            self.clear()
+        super(Memo, self).__setitem__(key, value)
+
+
+class Envelope(namedtuple('Envelope', ['image_format', 'width', 'height', 'mimetype', 'etag', 'size', 'chunks',
+                                       'data'])):
+    """
+    A rendered image as it is cached: what a response needs besides the
+    image (format, width and height, mimetype, ETag and size in bytes) and
+    the image itself, or for an image cached in chunks, how many chunks it
+    was split into. Packed into bytes with a short JSON header, so cache
+    backends keep it as it is instead of pickling it.
+    """
+
+    MAGIC = b'STE'
+    VERSION = 1
+    # magic, version, header length
+    PREFIX = struct.Struct('>3sBI')
+
+    def pack(self):
+        header = json.dumps({
+            'format': self.image_format,
+            'width': self.width,
+            'height': self.height,
+            'mime': self.mimetype,
+            'etag': self.etag,
+            'size': self.size,
+            'chunks': self.chunks,
+        }, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        return self.PREFIX.pack(self.MAGIC, self.VERSION, len(header)) + header + self.data
+
+    @classmethod
+    def unpack(cls, value):
+        """
+        The Envelope packed into value, or None if value is anything else,
+        such as an entry written by another version.
+        """
+        if not isinstance(value, bytes) or len(value) < cls.PREFIX.size:
+            return None
+        magic, version, header_length = cls.PREFIX.unpack_from(value)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            return None
+        start = cls.PREFIX.size + header_length
+        header = json.loads(value[cls.PREFIX.size:start].decode('utf-8'))
+        return cls(header['format'], header['width'], header['height'], header['mime'], header['etag'],
+                   header['size'], header['chunks'], value[start:])
+
+
+class LocalCache(object):
+    """
+    A small in-process LRU cache of rendered images, consulted before the
+    shared cache backend. Bounded by the total size in bytes of the values
+    it holds (SIMPLETHUMB_LOCAL_CACHE_SIZE); entries also expire after
+    SIMPLETHUMB_LOCAL_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self._data = OrderedDict()  # key -> (expiry time, value), least recently used first
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(settings.SIMPLETHUMB_LOCAL_CACHE_SIZE)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                self.size -= len(value)
+                self.misses += 1
+                return None
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        max_size = settings.SIMPLETHUMB_LOCAL_CACHE_SIZE
+        if not max_size or len(value) > max_size:
+            return
+        with self._lock:
+            self._discard(key)
+            self._data[key] = (time.time() + settings.SIMPLETHUMB_LOCAL_CACHE_TTL, value)
+            self.size += len(value)
+            while self.size > max_size:
+                self._discard(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._data),
+            'size': self.size,
+        }
+
+    def _discard(self, key):
+        try:
+            expires, value = self._data.pop(key)
+        except KeyError:
+            return
+        self.size -= len(value)
+
+
+local_cache = LocalCache()
@@ -16,6 +16,8 @@ class SimplethumbConf(AppConf):
     SIMPLETHUMB_FORMAT_EXT_MAP = {
         'JPEG': 'jpg',
         'PNG': 'png',
+        'WEBP': 'webp',
+        'AVIF': 'avif',
     }
 
     SIMPLETHUMB_CACHE_ENABLED = True
@@ -29,11 +31,102 @@ class SimplethumbConf(AppConf):
         'TIMEOUT': SIMPLETHUMB_CACHE_TTL,
     }
 
+    # Size in bytes of the in-process cache kept in front of the cache
+    # backend for the most requested thumbnails. 0 disables it.
+    SIMPLETHUMB_LOCAL_CACHE_SIZE = 0
+    SIMPLETHUMB_LOCAL_CACHE_TTL = 300
+
+    # How long concurrent requests for the same thumbnail wait for the one
+    # already rendering it before rendering it themselves. 0 disables.
+    SIMPLETHUMB_RENDER_LOCK_TIMEOUT = 30
+
+    # Images larger than this are encoded into a temporary file, cached in chunks of
+    # this size and streamed to the client
+    SIMPLETHUMB_CHUNK_SIZE = 512 * 1024
+
+    # Threads the async view renders in, and how many renders may be running or
+    # waiting for one before it answers 503
+    SIMPLETHUMB_RENDER_WORKERS = 4
+    SIMPLETHUMB_RENDER_QUEUE_SIZE = 32
+
+    # Bytes of decoded pixels (width x height x bands of each source) that renders in
+    # one process may hold at once; others queue, smallest first. 0 disables.
+    SIMPLETHUMB_RENDER_MEMORY = 0
+    # Seconds a render may queue for memory before the request gets a 503
+    SIMPLETHUMB_RENDER_QUEUE_TIMEOUT = 10
+
+    # Directory to keep rendered thumbnails in. When set, serve_image answers
+    # from these files instead of the cache.
+    SIMPLETHUMB_STORAGE_ROOT = None
+    # How the stored files are handed to the client: None (FileResponse),
+    # 'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd)
+    SIMPLETHUMB_SENDFILE_BACKEND = None
+    # Internal location prefix mapped to SIMPLETHUMB_STORAGE_ROOT, for x-accel-redirect
+    SIMPLETHUMB_STORAGE_URL = '/simplethumb-storage/'
+
+    # How long the template tag reuses the location and mtime of a source
+    # image before looking at the disk again. 0 checks on every call.
+    SIMPLETHUMB_SOURCE_CACHE_TIMEOUT = 10
+
+    # Storage class (dotted path) to look for sources in when they aren't static files,
+    # instead of MEDIA_ROOT. Fetched sources are kept in SIMPLETHUMB_SOURCE_CACHE_DIR
+    # (default: a directory in the system's temporary directory) up to a total of
+    # SIMPLETHUMB_SOURCE_CACHE_SIZE bytes.
+    SIMPLETHUMB_SOURCE_STORAGE = None
+    SIMPLETHUMB_SOURCE_CACHE_DIR = None
+    SIMPLETHUMB_SOURCE_CACHE_SIZE = 1024 * 1024 * 1024
+
     SIMPLETHUMB_DEFAULT_JPEG_QUALITY = 60
 
     SIMPLETHUMB_DEFAULT_OPTIMIZE_PNG = False
 
+    SIMPLETHUMB_DEFAULT_WEBP_QUALITY = 75
+
+    SIMPLETHUMB_DEFAULT_AVIF_QUALITY = 60
+
+    # Formats the 'auto' spec token may pick, in order of preference
+    SIMPLETHUMB_AUTO_FORMATS = ['AVIF', 'WEBP']
+
+    # Image processing backend, see simplethumb.engines
+    SIMPLETHUMB_ENGINE = 'simplethumb.engines.PilEngine'
+
+    # Decode JPEG/JPEG2000 (WebP with libvips) sources at a reduced size no smaller than this
+    # multiple of the thumbnail size. None decodes at full resolution.
+    SIMPLETHUMB_REDUCING_GAP = 2.0
+
+    # Render from a cached, larger rendition of the whole source instead of the source
+    # itself when there is one at least DERIVE_GAP times larger than needed, saved as PNG
+    # or with a quality of at least DERIVE_MIN_QUALITY. Needs the cache.
+    SIMPLETHUMB_DERIVE = False
+    SIMPLETHUMB_DERIVE_GAP = 2.0
+    SIMPLETHUMB_DERIVE_MIN_QUALITY = 85
+
+    # Serve the source file itself when a spec would neither resize nor convert it
+    SIMPLETHUMB_PASSTHROUGH = True
+
     SIMPLETHUMB_HMAC_KEY = settings.SECRET_KEY
 
+    # What renders the thumbnails of files saved to a SimplethumbImageField: a class
+    # (dotted path) with a submit(url, specs) method. The default renders in a pool of
+    # SIMPLETHUMB_UPLOAD_WORKERS threads.
+    SIMPLETHUMB_UPLOAD_RENDERER = 'simplethumb.fields.ThreadRenderer'
+    SIMPLETHUMB_UPLOAD_WORKERS = 2
+
+    # Where to send metrics: 'simplethumb.metrics.PrometheusSink', '...StatsdSink',
+    # '...SignalSink' or your own. None disables them.
+    SIMPLETHUMB_METRICS_BACKEND = None
+    SIMPLETHUMB_STATSD_HOST = 'localhost'
+    SIMPLETHUMB_STATSD_PORT = 8125
+
+    # Log renders taking longer than this many seconds, with a trace of their stages. None disables.
+    SIMPLETHUMB_SLOW_RENDER_THRESHOLD = None
+    # Dotted path to a callable that is given the trace of every render
+    SIMPLETHUMB_RENDER_TRACE_HOOK = None
+    # Include the peak of Python allocations (tracemalloc) in traces. Slows rendering down.
+    SIMPLETHUMB_TRACE_MEMORY = False
+    # Fraction of renders to run under cProfile, and where to write their stats
+    SIMPLETHUMB_PROFILE_SAMPLE_RATE = 0
+    SIMPLETHUMB_PROFILE_DIR = None
+
     class Meta:
         prefix = 'simplethumb'
@@ -0,0 +1,344 @@
+from __future__ import division
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+import PIL
+from PIL import Image as PilImage
+
+from simplethumb.conf import settings
+
+try:
+    from io import BytesIO
+except ImportError:
+    from BytesIO import BytesIO
+
+EXIF_ORIENTATION = 0x0112
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+
+def get_engine():
+    """
+    Return an instance of the engine named by SIMPLETHUMB_ENGINE.
+    """
+    return import_string(settings.SIMPLETHUMB_ENGINE)()
+
+
+class BaseEngine(object):
+    """
+    The pixel operations used by simplethumb.models.Image. Engines never
+    modify an image in place; every operation returns the image to use next.
+    """
+
+    #: modes that can be written without conversion
+    NATIVE_MODES = ('L', 'RGB', 'LA', 'RGBA')
+
+    @property
+    def version(self):
+        """
+        Name and version of the library doing the work. Part of the ETag,
+        since another version may well produce different bytes.
+        """
+        raise NotImplementedError
+
+    def open(self, path):
+        raise NotImplementedError
+
+    def open_buffer(self, data):
+        """
+        Open an encoded image held in memory.
+        """
+        raise NotImplementedError
+
+    def format(self, im):
+        """
+        Format of the source image, using PIL's names ('JPEG', 'PNG', ...)
+        """
+        raise NotImplementedError
+
+    def size(self, im):
+        raise NotImplementedError
+
+    def metadata(self, path):
+        """
+        Read what simplethumb.models.Image.metadata describes from the
+        header of the image at path, without decoding any pixels.
+        """
+        raise NotImplementedError
+
+    def draft(self, im, size):
+        """
+        Decode the image at a reduced size no smaller than size, if the
+        format allows it.
+        """
+        return im
+
+    def load(self, im):
+        """
+        Decode the pixels now rather than when they are first used, so the
+        image can be the base of several renders.
+        """
+        return im
+
+    def copy(self, im):
+        """
+        An image that can be worked on without affecting im.
+        """
+        return im
+
+    def normalize(self, im):
+        """
+        Convert anything that isn't one of NATIVE_MODES to RGB.
+        """
+        raise NotImplementedError
+
+    def drop_alpha(self, im):
+        raise NotImplementedError
+
+    def can_save(self, image_format):
+        """
+        Whether this engine can write image_format ('WEBP', 'AVIF', ...)
+        """
+        return True
+
+    def thumbnail(self, im, size):
+        """
+        Proportionally shrink the image to fit within size. Never enlarges.
+        """
+        raise NotImplementedError
+
+    def resize(self, im, size):
+        raise NotImplementedError
+
+    def crop(self, im, box):
+        raise NotImplementedError
+
+    def save(self, im, image_format, **params):
+        """
+        Encode the image and return the bytes.
+        """
+        raise NotImplementedError
+
+    def save_to(self, im, image_format, image_file, **params):
+        """
+        Encode the image into a file object.
+        """
+        image_file.write(self.save(im, image_format, **params))
+
+
+class PilEngine(BaseEngine):
+
+    @property
+    def version(self):
+        # PILLOW_VERSION was removed in Pillow 7, __version__ added in 5.2
+        return 'pillow-{}'.format(getattr(PIL, '__version__', None) or getattr(PIL, 'PILLOW_VERSION', ''))
+
+    def open(self, path):
+        return PilImage.open(path)
+
+    def open_buffer(self, data):
+        return PilImage.open(BytesIO(data))
+
+    def format(self, im):
+        return im.format
+
+    def size(self, im):
+        return im.size
+
+    def metadata(self, path):
+        with PilImage.open(path) as im:
+            try:
+                orientation = im.getexif().get(EXIF_ORIENTATION, 1)
+            except AttributeError:
+                # Pillow < 6
+                orientation = 1
+            return {
+                'width': im.size[0],
+                'height': im.size[1],
+                'mode': im.mode,
+                'format': im.format,
+                'orientation': orientation,
+                'icc': bool(im.info.get('icc_profile')),
+            }
+
+    def draft(self, im, size):
+        if im.format == 'JPEG':
+            # DCT scaling; picks the smallest of 1/2, 1/4, 1/8 that is still large enough
+            im.draft(im.mode, size)
+        elif im.format == 'JPEG2000':
+            width = im.size[0]
+            reduce_by = 0
+            while width // (2 ** (reduce_by + 1)) >= size[0]:
+                reduce_by += 1
+            if reduce_by:
+                im.reduce = reduce_by
+                try:
+                    im.load()
+                except OSError:
+                    # Pillow rounds the reduced size differently from openjpeg when the
+                    # source size isn't a multiple of 2 ** reduce_by; decode at full size
+                    im = PilImage.open(im.filename)
+        return im
+
+    def load(self, im):
+        im.load()
+        return im
+
+    def copy(self, im):
+        # thumbnail() works in place
+        return im.copy()
+
+    def normalize(self, im):
+        if im.mode not in self.NATIVE_MODES:
+            im = im.convert('RGB')
+        return im
+
+    def drop_alpha(self, im):
+        if im.mode == 'RGBA':
+            im = im.convert('RGB')
+        return im
+
+    def can_save(self, image_format):
+        PilImage.init()
+        return image_format in PilImage.SAVE
+
+    def thumbnail(self, im, size):
+        im.thumbnail(size, PilImage.ANTIALIAS)
+        return im
+
+    def resize(self, im, size):
+        return im.resize(size, PilImage.ANTIALIAS)
+
+    def crop(self, im, box):
+        return im.crop(box)
+
+    def save(self, im, image_format, **params):
+        image_str = BytesIO()
+        self.save_to(im, image_format, image_str, **params)
+        image_data = image_str.getvalue()
+        image_str.close()
+        return image_data
+
+    def save_to(self, im, image_format, image_file, **params):
+        im.save(image_file, image_format, **params)
+
+
+class VipsEngine(BaseEngine):
+    """
+    libvips backend. Requires pyvips.
+    """
+
+    LOADER_FORMATS = {
+        'jpegload': 'JPEG',
+        'pngload': 'PNG',
+        'webpload': 'WEBP',
+        'gifload': 'GIF',
+        'tiffload': 'TIFF',
+        'jp2kload': 'JPEG2000',
+    }
+    FORMAT_SUFFIXES = {
+        'JPEG': '.jpg',
+        'PNG': '.png',
+        'WEBP': '.webp',
+        'AVIF': '.avif',
+        'GIF': '.gif',
+        'TIFF': '.tif',
+        'JPEG2000': '.jp2',
+    }
+
+    def __init__(self):
+        if pyvips is None:
+            raise ImproperlyConfigured('VipsEngine requires the pyvips package')
+
+    @property
+    def version(self):
+        return 'vips-{}.{}.{}'.format(pyvips.version(0), pyvips.version(1), pyvips.version(2))
+
+    def open(self, path):
+        return pyvips.Image.new_from_file(path)
+
+    def open_buffer(self, data):
+        return pyvips.Image.new_from_buffer(data, '')
+
+    def format(self, im):
+        loader = im.get('vips-loader')
+        for prefix, image_format in self.LOADER_FORMATS.items():
+            if loader.startswith(prefix):
+                return image_format
+        return None
+
+    def size(self, im):
+        return im.width, im.height
+
+    def metadata(self, path):
+        im = self.open(path)
+        fields = im.get_fields()
+        return {
+            'width': im.width,
+            'height': im.height,
+            'mode': self.mode(im),
+            'format': self.format(im),
+            'orientation': im.get('orientation') if 'orientation' in fields else 1,
+            'icc': 'icc-profile-data' in fields,
+        }
+
+    def mode(self, im):
+        """
+        The PIL mode closest to the image's interpretation and bands.
+        """
+        if im.interpretation == 'cmyk':
+            return 'CMYK'
+        if im.interpretation in ('b-w', 'grey16'):
+            return 'LA' if im.hasalpha() else 'L'
+        return 'RGBA' if im.hasalpha() else 'RGB'
+
+    def draft(self, im, size):
+        image_format = self.format(im)
+        if image_format == 'JPEG':
+            shrink = 1
+            while shrink < 8 and im.width // (shrink * 2) >= size[0] and im.height // (shrink * 2) >= size[1]:
+                shrink *= 2
+            if shrink > 1:
+                im = pyvips.Image.new_from_file(im.filename, shrink=shrink)
+        elif image_format == 'WEBP':
+            im = pyvips.Image.new_from_file(im.filename, scale=max(size[0] / im.width, size[1] / im.height))
+        return im
+
+    def load(self, im):
+        return im.copy_memory()
+
+    def normalize(self, im):
+        if im.interpretation not in ('srgb', 'b-w'):
+            im = im.colourspace('srgb')
+        return im
+
+    def drop_alpha(self, im):
+        if im.hasalpha() and im.bands == 4:
+            im = im.extract_band(0, n=3)
+        return im
+
+    def can_save(self, image_format):
+        return self.FORMAT_SUFFIXES.get(image_format) in pyvips.base.get_suffixes()
+
+    def thumbnail(self, im, size):
+        if im.width <= size[0] and im.height <= size[1]:
+            return im
+        return im.thumbnail_image(size[0], height=size[1], size='down')
+
+    def resize(self, im, size):
+        return im.resize(size[0] / im.width, vscale=size[1] / im.height)
+
+    def crop(self, im, box):
+        left, top, right, bottom = [int(v) for v in box]
+        return im.crop(left, top, right - left, bottom - top)
+
+    def save(self, im, image_format, **params):
+        options = {}
+        if 'quality' in params:
+            options['Q'] = params['quality']
+        if params.get('optimize'):
+            options['compression'] = 9
+        return im.write_to_buffer(self.FORMAT_SUFFIXES[image_format], **options)
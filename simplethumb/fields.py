@@ -0,0 +1,150 @@
+"""
+Rendering thumbnails of uploads as soon as they are saved, so the first
+visitor doesn't wait for them.
+
+SimplethumbImageField is an ImageField that, once a model instance with a
+new file is saved (and its transaction committed), hands the file's url
+and the field's specs to the renderer named by
+SIMPLETHUMB_UPLOAD_RENDERER. The default renders in a pool of threads;
+point it at a class of your own to send the work to a task queue instead,
+calling render_upload() from the task.
+"""
+import logging
+import threading
+
+from django.db import transaction
+from django.db.models import ImageField, signals
+from django.utils.module_loading import import_string
+
+from simplethumb.conf import settings
+from simplethumb.models import Image
+from simplethumb.templatetags.simplethumb_tags import _source_url
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+logger = logging.getLogger('simplethumb')
+
+_renderer = (None, None)  # (SIMPLETHUMB_UPLOAD_RENDERER it was made for, renderer)
+_renderer_lock = threading.Lock()
+
+
+def get_upload_renderer():
+    global _renderer
+    backend = settings.SIMPLETHUMB_UPLOAD_RENDERER
+    if _renderer[0] != backend:
+        with _renderer_lock:
+            if _renderer[0] != backend:
+                _renderer = (backend, import_string(backend)())
+    return _renderer[1]
+
+
+def render_upload(url, specs):
+    """
+    Render the source at url (as the simplethumb tag would be given it)
+    with each of specs, into the cache or SIMPLETHUMB_STORAGE_ROOT. Logs
+    rather than raises errors, since nobody is waiting for the result.
+    """
+    try:
+        if settings.SIMPLETHUMB_STORAGE_ROOT:
+            for spec in specs:
+                Image(url=url, spec=spec).store()
+        else:
+            Image(url=url).render_many(specs)
+    except Exception:
+        logger.exception('Rendering thumbnails of upload %s failed', url)
+
+
+class SyncRenderer(object):
+    """
+    Renders in the thread saving the model.
+    """
+
+    def submit(self, url, specs):
+        render_upload(url, specs)
+
+
+class ThreadRenderer(object):
+    """
+    Renders in a pool of SIMPLETHUMB_UPLOAD_WORKERS threads.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=settings.SIMPLETHUMB_UPLOAD_WORKERS)
+        return self._executor
+
+    def submit(self, url, specs):
+        if ThreadPoolExecutor is None:
+            thread = threading.Thread(target=render_upload, args=(url, specs))
+            thread.daemon = True
+            thread.start()
+            return thread
+        return self.executor.submit(render_upload, url, specs)
+
+
+class SimplethumbImageField(ImageField):
+    """
+    An ImageField that renders the thumbnails of each new file once it is
+    saved. specs are spec strings or preset names, all of
+    SIMPLETHUMB_PRESETS if not given.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.specs = kwargs.pop('specs', None)
+        super(SimplethumbImageField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(SimplethumbImageField, self).deconstruct()
+        if self.specs is not None:
+            kwargs['specs'] = self.specs
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(SimplethumbImageField, self).contribute_to_class(cls, name, **kwargs)
+        if not cls._meta.abstract:
+            signals.post_init.connect(self.remember_name, sender=cls)
+            signals.post_save.connect(self.render_thumbnails, sender=cls)
+
+    @property
+    def _name_attr(self):
+        return '_simplethumb_{}'.format(self.attname)
+
+    def get_specs(self):
+        return list(self.specs) if self.specs is not None else sorted(settings.SIMPLETHUMB_PRESETS)
+
+    def remember_name(self, instance, **kwargs):
+        """
+        Note the name of the file the instance was loaded with, to tell
+        whether it changed when it is saved.
+        """
+        # a deferred field would have to be fetched; it can't have changed if it wasn't loaded
+        if self.attname in instance.__dict__:
+            instance.__dict__[self._name_attr] = getattr(instance, self.attname).name or None
+
+    def render_thumbnails(self, instance, created=False, raw=False, using=None, **kwargs):
+        if raw:
+            # loading fixtures
+            return
+        field_file = getattr(instance, self.attname)
+        name = field_file.name or None
+        if name == instance.__dict__.get(self._name_attr) and not created:
+            return
+        instance.__dict__[self._name_attr] = name
+        if name is None:
+            return
+
+        # the url the simplethumb tag will be given
+        url = _source_url(field_file)
+        specs = self.get_specs()
+        transaction.on_commit(lambda: get_upload_renderer().submit(url, specs), using=using)
@@ -0,0 +1,72 @@
+import threading
+import time
+from contextlib import contextmanager
+
+#: seconds between cache reads while waiting on another process's render
+POLL_INTERVAL = 0.1
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def single_flight(key, func, timeout):
+    """
+    Call func() once for all threads in this process asking for the same key
+    at the same time. Callers that arrive while a call is in flight wait up
+    to timeout seconds and share its result; if the call fails or takes too
+    long they call func() themselves.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if flight.done.wait(timeout) and flight.result is not None:
+            return flight.result
+        return func()
+
+    try:
+        flight.result = func()
+        return flight.result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+@contextmanager
+def cache_lease(cache, key, timeout):
+    """
+    Try to take a lease on key that is visible to every process sharing the
+    cache backend. Yields True if this caller holds the lease. The lease
+    expires on its own after timeout seconds should the holder die.
+    """
+    lease_key = 'lease:{}'.format(key)
+    acquired = cache.add(lease_key, 1, timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            cache.delete(lease_key)
+
+
+def wait_for(cache, key, timeout):
+    """
+    Poll the cache for key for up to timeout seconds. Returns None if
+    nothing shows up.
+    """
+    for _ in range(int(timeout / POLL_INTERVAL)):
+        value = cache.get(key)
+        if value:
+            return value
+        time.sleep(POLL_INTERVAL)
+    return None
@@ -0,0 +1,153 @@
+from __future__ import division
+
+import fnmatch
+import multiprocessing
+import os
+import time
+
+from django.contrib.staticfiles import finders
+from django.core.management.base import BaseCommand, CommandError
+
+from simplethumb.conf import settings
+from simplethumb.models import Image, cached_many
+
+
+def find_sources(patterns):
+    """
+    Expand the given paths/globs against the static files known to the
+    staticfiles finders and the files under MEDIA_ROOT. Returns the urls
+    the simplethumb tag would be given for them.
+    """
+    static_paths = set()
+    for finder in finders.get_finders():
+        for path, storage in finder.list([]):
+            static_paths.add(path.replace(os.sep, '/'))
+
+    media_paths = set()
+    if settings.MEDIA_ROOT and os.path.isdir(settings.MEDIA_ROOT):
+        for root, dirs, files in os.walk(settings.MEDIA_ROOT):
+            for name in files:
+                path = os.path.relpath(os.path.join(root, name), settings.MEDIA_ROOT)
+                media_paths.add(path.replace(os.sep, '/'))
+
+    urls = []
+    for pattern in patterns:
+        for path in sorted(static_paths):
+            if fnmatch.fnmatch(path, pattern):
+                urls.append(path)
+        for path in sorted(media_paths - static_paths):
+            if fnmatch.fnmatch(path, pattern):
+                urls.append(settings.MEDIA_URL + path)
+
+    # keep the first occurrence of each url
+    seen = set()
+    return [url for url in urls if not (url in seen or seen.add(url))]
+
+
+def warm(job):
+    """
+    Render one source with each of the specs. Runs in a pool worker, so it
+    reports errors rather than raising them. Returns (url, spec, status,
+    source size, error) for each spec; the source size is only given with
+    the first spec rendered, so each source counts once.
+    """
+    url, specs = job
+    results = []
+    source_size = 0
+    try:
+        if settings.SIMPLETHUMB_STORAGE_ROOT:
+            for spec in specs:
+                image = Image(url=url, spec=spec)
+                if os.path.exists(image.stored_path):
+                    results.append((url, spec, 'skipped', 0, None))
+                    continue
+                image.store()
+                source_size = image.stat.st_size
+                results.append((url, spec, 'rendered', 0, None))
+        else:
+            source = Image(url=url)
+            source_size = source.stat.st_size
+            pending = []
+            images = [source.with_spec(spec) for spec in specs]
+            for spec, image, envelope in zip(specs, images, cached_many(images)):
+                # passthrough specs are served from the source, there is nothing to render
+                if envelope or image.passthrough:
+                    results.append((url, spec, 'skipped', 0, None))
+                else:
+                    pending.append(spec)
+            # the source is decoded once for all of them
+            source.render_many(pending)
+            results.extend((url, spec, 'rendered', 0, None) for spec in pending)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+        done = set(result[1] for result in results)
+        results.extend((url, spec, 'failed', 0, error) for spec in specs if spec not in done)
+
+    for index, (url, spec, status, size, error) in enumerate(results):
+        if status == 'rendered':
+            results[index] = (url, spec, status, source_size, error)
+            break
+    return results
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnails ahead of time so the first visitor does not have to wait for them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+',
+                            help='Static or media file paths to render, shell-style globs allowed')
+        parser.add_argument('-s', '--spec', action='append', dest='specs', default=[],
+                            help='Spec string or SIMPLETHUMB_PRESETS name, may be repeated. '
+                                 'Defaults to all presets.')
+        parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(),
+                            help='Number of worker processes')
+        parser.add_argument('--progress', type=int, default=100,
+                            help='Report progress every this many images')
+
+    def handle(self, *args, **options):
+        if not (settings.SIMPLETHUMB_CACHE_ENABLED or settings.SIMPLETHUMB_STORAGE_ROOT):
+            raise CommandError('Neither the simplethumb cache nor SIMPLETHUMB_STORAGE_ROOT is enabled, '
+                               'there is nowhere to keep the rendered thumbnails.')
+
+        specs = options['specs'] or sorted(settings.SIMPLETHUMB_PRESETS)
+        urls = find_sources(options['sources'])
+        if not urls:
+            raise CommandError('No source images found.')
+
+        # images already rendered are skipped, so an interrupted run can simply be restarted
+        jobs = [(url, specs) for url in urls]
+        total = len(urls) * len(specs)
+        done = 0
+        counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+        source_bytes = 0
+        start = time.time()
+
+        if options['processes'] > 1:
+            pool = multiprocessing.Pool(options['processes'])
+            results = pool.imap_unordered(warm, jobs)
+        else:
+            pool = None
+            results = (warm(job) for job in jobs)
+
+        try:
+            for job_results in results:
+                for url, spec, status, size, error in job_results:
+                    done += 1
+                    counts[status] += 1
+                    source_bytes += size
+                    if error:
+                        self.stderr.write('{} [{}]: {}'.format(url, spec, error))
+                    if options['progress'] and done % options['progress'] == 0:
+                        self.stdout.write('{}/{}'.format(done, total))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.stdout.write(
+            '{rendered} rendered, {skipped} skipped, {failed} failed in {elapsed:.1f}s '
+            '({rate:.1f} images/s, {mb_rate:.1f} source MB/s)'.format(
+                elapsed=elapsed,
+                rate=counts['rendered'] / elapsed,
+                mb_rate=source_bytes / elapsed / (1024 * 1024),
+                **counts))
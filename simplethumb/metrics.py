@@ -0,0 +1,209 @@
+"""
+Counters, timings, sizes and gauges from the render pipeline, sent to the
+sink named by SIMPLETHUMB_METRICS_BACKEND. With no sink configured every
+call returns straight away.
+
+Metric names are dotted ('cache.hit', 'stage.encode'); sinks adapt them to
+their own conventions.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+from simplethumb.conf import settings
+
+# sent by SignalSink with kind ('incr', 'timing', 'gauge' or 'observe'), name and value
+metric = Signal()
+
+_sink = (None, None)  # (SIMPLETHUMB_METRICS_BACKEND it was made for, sink)
+_sink_lock = threading.Lock()
+_in_progress = {}
+# timings recorded for the render running in this thread (see record_timings)
+_local = threading.local()
+
+
+def get_sink():
+    global _sink
+    backend = settings.SIMPLETHUMB_METRICS_BACKEND
+    if not backend:
+        return None
+    if _sink[0] != backend:
+        with _sink_lock:
+            if _sink[0] != backend:
+                _sink = (backend, import_string(backend)())
+    return _sink[1]
+
+
+def incr(name, value=1):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr(name, value)
+
+
+def observe(name, value):
+    """
+    Record one value of a distribution, e.g. a size in bytes.
+    """
+    sink = get_sink()
+    if sink is not None:
+        sink.observe(name, value)
+
+
+@contextmanager
+def timer(name):
+    """
+    Time the block and record it as a timing in seconds.
+    """
+    sink = get_sink()
+    timings = getattr(_local, 'timings', None)
+    if sink is None and timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        if sink is not None:
+            sink.timing(name, seconds)
+        if timings is not None:
+            timings.append((name, seconds))
+
+
+@contextmanager
+def record_timings():
+    """
+    Collect the timings of this thread's timer() blocks into a list of
+    (name, seconds), whether or not a sink is configured.
+    """
+    timings = _local.timings = []
+    try:
+        yield timings
+    finally:
+        del _local.timings
+
+
+@contextmanager
+def in_progress(name):
+    """
+    Count the block's executions running at the same time, as a gauge.
+    """
+    sink = get_sink()
+    if sink is None:
+        yield
+        return
+    with _sink_lock:
+        _in_progress[name] = _in_progress.get(name, 0) + 1
+        sink.gauge(name, _in_progress[name])
+    try:
+        yield
+    finally:
+        with _sink_lock:
+            _in_progress[name] -= 1
+            sink.gauge(name, _in_progress[name])
+
+
+class BaseSink(object):
+    def incr(self, name, value):
+        raise NotImplementedError
+
+    def timing(self, name, seconds):
+        raise NotImplementedError
+
+    def gauge(self, name, value):
+        raise NotImplementedError
+
+    def observe(self, name, value):
+        raise NotImplementedError
+
+
+class SignalSink(BaseSink):
+    """
+    Sends every metric as the simplethumb.metrics.metric signal.
+    """
+
+    def send(self, kind, name, value):
+        metric.send(sender=self.__class__, kind=kind, name=name, value=value)
+
+    def incr(self, name, value):
+        self.send('incr', name, value)
+
+    def timing(self, name, seconds):
+        self.send('timing', name, seconds)
+
+    def gauge(self, name, value):
+        self.send('gauge', name, value)
+
+    def observe(self, name, value):
+        self.send('observe', name, value)
+
+
+class StatsdSink(BaseSink):
+    """
+    Sends metrics to statsd, prefixed with 'simplethumb.'. Requires the
+    statsd package; uses SIMPLETHUMB_STATSD_HOST and SIMPLETHUMB_STATSD_PORT.
+    Distributions are sent as timers, which statsd aggregates the same way.
+    """
+
+    def __init__(self):
+        import statsd
+        self.client = statsd.StatsClient(settings.SIMPLETHUMB_STATSD_HOST, settings.SIMPLETHUMB_STATSD_PORT,
+                                         prefix='simplethumb')
+
+    def incr(self, name, value):
+        self.client.incr(name, value)
+
+    def timing(self, name, seconds):
+        self.client.timing(name, seconds * 1000)
+
+    def gauge(self, name, value):
+        self.client.gauge(name, value)
+
+    def observe(self, name, value):
+        self.client.timing(name, value)
+
+
+class PrometheusSink(BaseSink):
+    """
+    Records metrics with prometheus_client in its default registry, named
+    simplethumb_<name>_total (counters), simplethumb_<name>_seconds
+    (timings), simplethumb_<name>_bytes (distributions) and
+    simplethumb_<name> (gauges). Expose them with prometheus_client's own
+    view or server.
+    """
+
+    BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+    def __init__(self):
+        import prometheus_client
+        self.prometheus_client = prometheus_client
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, metric_type, name, suffix='', **kwargs):
+        key = (metric_type, name)
+        try:
+            return self.metrics[key]
+        except KeyError:
+            pass
+        with self.lock:
+            if key not in self.metrics:
+                full_name = 'simplethumb_{}{}'.format(name.replace('.', '_'), suffix)
+                self.metrics[key] = getattr(self.prometheus_client, metric_type)(full_name, name, **kwargs)
+        return self.metrics[key]
+
+    def incr(self, name, value):
+        # prometheus_client appends _total itself
+        self.get('Counter', name).inc(value)
+
+    def timing(self, name, seconds):
+        self.get('Histogram', name, '_seconds').observe(seconds)
+
+    def gauge(self, name, value):
+        self.get('Gauge', name).set(value)
+
+    def observe(self, name, value):
+        self.get('Histogram', name, '_bytes', buckets=self.BYTE_BUCKETS).observe(value)
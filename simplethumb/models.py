@@ -1,111 +1,440 @@
 from __future__ import division
 
+import copy
+import errno
+import hashlib
+import math
 import mimetypes
+import tempfile
+import time
 from base64 import b64encode
+from io import BytesIO
 
-from PIL import Image as PilImage
 from django.contrib.staticfiles import finders
 from django.core.cache import caches
 
+from simplethumb import metrics, profiling
+from simplethumb.cache import Envelope, Memo, local_cache
 from simplethumb.conf import settings
+from simplethumb.engines import get_engine
+from simplethumb.locks import single_flight, cache_lease, wait_for
+from simplethumb.scheduler import render_scheduler
+from simplethumb.sources import get_source_storage, source_cache, storage_stat
 from simplethumb.spec import Spec, LittleFloat
-
-try:
-    import BytesIO
-except ImportError:
-    from io import BytesIO
 import os
 
 image_cache = caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME]
 
+# not known to every python version's mimetypes
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+# formats an 'auto' spec can pick: engine format name -> (spec format, mimetype)
+AUTO_FORMATS = {
+    'AVIF': (Spec.FORMAT_AVIF, 'image/avif'),
+    'WEBP': (Spec.FORMAT_WEBP, 'image/webp'),
+}
+
+# prefix of cache keys, changed along with the way images are cached
+CACHE_KEY_PREFIX = 'st1:'
+
+# most renditions of one source remembered for deriving others from
+MAX_RENDITIONS = 16
+
+# basename -> (time checked, path, stat, storage name)
+_source_memo = Memo()
+# spec string -> Spec
+_spec_memo = Memo()
+# metadata cache key -> source metadata
+_metadata_memo = Memo()
+
 
 class Image(object):
     PROCESS_ORDER = [Spec.TOKEN_CROP_RATIO, Spec.TOKEN_CROP, Spec.TOKEN_SCALE, Spec.TOKEN_WIDTH, Spec.TOKEN_HEIGHT,
                      Spec.TOKEN_IMAGEFMT]
 
-    def __init__(self, url='', spec=None):
+    def __init__(self, url='', spec=None, source_max_age=0):
         self.original_url = url
-        self.path = None
+        self._path = None
         self.stat = None
-        self._find_fs_image()
+        # name in SIMPLETHUMB_SOURCE_STORAGE, for sources found there
+        self.storage_name = None
+        self._metadata = None
+        self._find_fs_image(source_max_age)
 
         self._spec = None
         if spec is not None:
             self.spec = spec
 
+        self.engine = get_engine()
+        self.negotiated_fmt = Spec.FORMAT_UNDEF
+        self._reset()
+
+    def _reset(self):
+        """
+        Forget everything a render works out along the way.
+        """
         self.save_params = {}
         self.image_format = ''
-        self.pil = None
+        self.im = None
+        self.source_size = None
+        self.draft_scale = 1.0
+        # Envelope of the image last rendered or read from the cache
+        self.envelope = None
+        # temporary file holding the last render, if it was cached in chunks
+        self.rendered_file = None
+        # size of the last render, and whether it was derived from a cached rendition
+        self.rendered_size = None
+        self.derived = False
 
         self.jpeg_quality = settings.SIMPLETHUMB_DEFAULT_JPEG_QUALITY
         self.optimize_png = settings.SIMPLETHUMB_DEFAULT_OPTIMIZE_PNG
+        self.webp_quality = settings.SIMPLETHUMB_DEFAULT_WEBP_QUALITY
+        self.avif_quality = settings.SIMPLETHUMB_DEFAULT_AVIF_QUALITY
+
+    def with_spec(self, spec):
+        """
+        An Image of the same source (and negotiated format) with another
+        spec, without looking for the source again.
+        """
+        image = copy.copy(self)
+        image.spec = spec
+        image._reset()
+        return image
 
     @property
     def cached(self):
-        return image_cache.get(self.cache_key)
+        """
+        The cached image's Envelope, or None.
+        """
+        return cached_many([self])[0]
 
     @property
     def basename(self):
         return self.original_url.lstrip('/')
 
+    @property
+    def output_fmt(self):
+        if self.spec.image_fmt == Spec.FORMAT_AUTO:
+            return self.negotiated_fmt
+        return self.spec.image_fmt
+
     @property
     def ext(self):
         try:
-            return Spec.FORMAT_EXT_MAP[self.spec.image_fmt]
+            return Spec.FORMAT_EXT_MAP[self.output_fmt]
         except KeyError:
             return os.path.splitext(self.original_url)[1].lstrip('.')
 
     @property
     def cache_key(self):
-        return '.'.join([self.basename, b64encode(self.spec.encoded).decode()])
+        """
+        Fixed-length key of the rendered image: a digest of the source's id,
+        mtime and size, the encoded spec, the output format and the engine
+        version. A changed source never maps onto a stale entry, and the key
+        stays within memcached's limits however long the path.
+        """
+        digest = hashlib.sha1('{}:{}:{}:{}'.format(
+            self.source_key, b64encode(self.spec.encoded).decode(), self.ext, self.engine.version).encode())
+        return CACHE_KEY_PREFIX + digest.hexdigest()
+
+    @property
+    def stored_name(self):
+        """
+        Location of the rendered image relative to SIMPLETHUMB_STORAGE_ROOT.
+        The source mtime is part of the digest so a changed source never
+        maps onto a stale file.
+        """
+        digest = hashlib.sha1('{}:{}'.format(self.cache_key, self.mtime).encode()).hexdigest()
+        return '/'.join([digest[:2], digest[2:4], '.'.join([digest, self.ext])])
+
+    @property
+    def stored_path(self):
+        return os.path.join(settings.SIMPLETHUMB_STORAGE_ROOT, *self.stored_name.split('/'))
+
+    @property
+    def etag(self):
+        """
+        Strong ETag for the rendered image, from the encoded spec (and
+        negotiated format), the source's mtime and size and the engine
+        version. Known without rendering anything.
+        """
+        digest = hashlib.sha1('{}:{}:{}:{}'.format(
+            self.cache_key, self.mtime, self.stat.st_size, self.engine.version).encode()).hexdigest()
+        return '"{}"'.format(digest)
 
     @property
     def url(self):
-        return '.'.join([self.cache_key, self.ext])
+        return '.'.join([self.basename, b64encode(self.spec.encoded).decode(), self.ext])
 
     @property
     def spec(self):
         return self._spec
 
+    @property
+    def path(self):
+        """
+        Local path of the source. Sources in SIMPLETHUMB_SOURCE_STORAGE are
+        fetched into the local source cache the first time it's needed.
+        """
+        if self._path is None and self.storage_name is not None:
+            self._path = source_cache.fetch(get_source_storage(), self.storage_name, self.mtime)
+        return self._path
+
+    @property
+    def source_id(self):
+        """
+        Identifies the source without fetching it.
+        """
+        if self.storage_name is not None:
+            return 'storage:' + self.storage_name
+        return self.path
+
     @property
     def mtime(self):
         return self.stat.st_mtime
 
+    @property
+    def source_key(self):
+        """
+        Digest of the source's id, mtime and size, for caching things
+        about this version of the source.
+        """
+        return hashlib.sha1(
+            '{}:{}:{}'.format(self.source_id, self.mtime, self.stat.st_size).encode()).hexdigest()
+
+    @property
+    def metadata(self):
+        """
+        Information about the source read from its header: width, height,
+        mode, format, orientation (EXIF, 1 if absent) and icc (whether it
+        carries a colour profile). Kept in the cache backend keyed on the
+        path, mtime and size of the source, so it is read once per change.
+        """
+        if self._metadata is None:
+            key = 'meta:{}'.format(self.source_key)
+            metadata = _metadata_memo.get(key)
+            if metadata is None and settings.SIMPLETHUMB_CACHE_ENABLED:
+                metadata = image_cache.get(key)
+            if metadata is None:
+                metadata = self.engine.metadata(self.path)
+                if settings.SIMPLETHUMB_CACHE_ENABLED:
+                    image_cache.set(key, metadata)
+            _metadata_memo[key] = self._metadata = metadata
+        return self._metadata
+
+    @property
+    def passthrough(self):
+        """
+        True when rendering would only re-encode the source: the spec leaves
+        its size alone and asks for no format, or for the source's own
+        format with default settings, and no EXIF orientation rotates the
+        source. Decided from the metadata alone.
+        """
+        if not settings.SIMPLETHUMB_PASSTHROUGH:
+            return False
+        metadata = self.metadata
+        if metadata['mode'] not in self.engine.NATIVE_MODES + ('P',):
+            # would be converted
+            return False
+        if metadata['orientation'] != 1:
+            # browsers would rotate the source, but not its thumbnails, which lose the EXIF
+            return False
+        if self.output_fmt != Spec.FORMAT_UNDEF:
+            if self.spec.formatarg or Spec.FORMAT_MAP[self.output_fmt] != 'format_{}'.format(
+                    (metadata['format'] or '').lower()):
+                return False
+        return self.output_size == self.dimensions
+
+    @property
+    def format_supported(self):
+        """
+        Whether the engine can write the format the spec asks for. Formats
+        it can't write are never picked by an 'auto' spec.
+        """
+        for image_format, (spec_format, mimetype) in AUTO_FORMATS.items():
+            if self.spec.image_fmt == spec_format:
+                return self.engine.can_save(image_format)
+        return True
+
+    @property
+    def memory_cost(self):
+        """
+        Estimated bytes needed to hold the decoded source: width x height x
+        bands, counting 4 bands for modes that get converted.
+        """
+        mode = self.metadata['mode']
+        bands = len(mode) if mode in self.engine.NATIVE_MODES else 4
+        return self.metadata['width'] * self.metadata['height'] * bands
+
+    @property
+    def dimensions(self):
+        """
+        (width, height) of the source image.
+        """
+        return self.metadata['width'], self.metadata['height']
+
     @spec.setter
     def spec(self, preset=None):
         if isinstance(preset, Spec):
             self._spec = preset
         else:
-            preset_string = getattr(settings, 'SIMPLETHUMB_PRESETS', {}).get(preset, None) or preset
-            self._spec = Spec.from_string(preset_string)
+            presets = getattr(settings, 'SIMPLETHUMB_PRESETS', {})
+            preset_string = (presets[preset] or '') if preset in presets else preset
+            spec = _spec_memo.get(preset_string)
+            if spec is None:
+                spec = _spec_memo[preset_string] = Spec.from_string(preset_string)
+            self._spec = spec
 
     @property
     def mimetype(self):
-        return mimetypes.guess_type(self)
+        return mimetypes.guess_type('.'.join(['image', self.ext]))[0]
 
-    def _find_fs_image(self):
-        image_path = finders.find(os.path.normpath(self.basename).lstrip('/'))
-        if not image_path:
-            image_path = os.path.join(
-                settings.MEDIA_ROOT,
-                self.basename.lstrip(settings.MEDIA_URL)
-            )
+    def negotiate(self, accept):
+        """
+        Choose the output format of an 'auto' spec from the Accept header:
+        the first of SIMPLETHUMB_AUTO_FORMATS the client explicitly accepts
+        and the engine can write. Otherwise the source format is kept.
+        """
+        accepted = accepted_types(accept)
+        for image_format in settings.SIMPLETHUMB_AUTO_FORMATS:
+            spec_format, mimetype = AUTO_FORMATS[image_format]
+            if mimetype in accepted and self.engine.can_save(image_format):
+                self.negotiated_fmt = spec_format
+                return
+        self.negotiated_fmt = Spec.FORMAT_UNDEF
+
+    def _find_fs_image(self, max_age=0):
+        """
+        Locate the source image: a static file, then a file in
+        SIMPLETHUMB_SOURCE_STORAGE if one is set, otherwise a file under
+        MEDIA_ROOT. With max_age, a location and stat found less than
+        max_age seconds ago are reused without looking again.
+        """
+        if max_age:
+            memo = _source_memo.get(self.basename)
+            if memo and memo[0] > time.time() - max_age:
+                self._path, self.stat, self.storage_name = memo[1:]
+                return
+
+        image_name = os.path.normpath(self.basename).lstrip('/')
+        image_path = finders.find(image_name)
+        storage = get_source_storage()
+        if not image_path and storage is not None:
+            self.stat = storage_stat(storage, image_name)
+            self.storage_name = image_name
+        else:
+            if not image_path:
+                image_name = self.basename
+                media_url = settings.MEDIA_URL.lstrip('/')
+                if media_url and image_name.startswith(media_url):
+                    image_name = image_name[len(media_url):]
+                image_path = os.path.join(settings.MEDIA_ROOT, image_name)
+
+            self.stat = os.stat(image_path)
+            self._path = image_path
+        if max_age:
+            _source_memo[self.basename] = (time.time(), self._path, self.stat, self.storage_name)
+
+    def _plan(self, size):
+        """
+        Follow the filters in the spec from a source of the given size,
+        without touching any pixels. Returns the size of the output and the
+        largest fraction of the source size that any resize step needs.
+        """
+        width, height = size
+        scale = 1.0
+        needed = 0.0
+
+        def fit(box_w, box_h):
+            # same result as thumbnail(), give or take rounding
+            box_w, box_h = int(box_w or width), int(box_h or height)
+            if box_w >= width and box_h >= height:
+                return width, height
+            if float(box_w) / box_h >= float(width) / height:
+                return max(int(round(box_h * float(width) / height)), 1), box_h
+            return box_w, max(int(round(box_w * float(height) / width)), 1)
+
+        def crop_to(box_w, box_h):
+            if width <= box_w and height <= box_h:
+                return width, height
+            return int(box_w), int(box_h)
+
+        if self.spec.crop_ratio:
+            new_ratio = LittleFloat.unpack(self.spec.crop_ratio)
+            if float(width) / height >= new_ratio:
+                width, height = crop_to(round(height * new_ratio), height)
+            else:
+                width, height = crop_to(width, round(width / new_ratio))
+        if self.spec.crop:
+            if self.spec.height >= self.spec.width:
+                new_width, new_height = fit(None, self.spec.height)
+            else:
+                new_width, new_height = fit(self.spec.width, None)
+            scale *= float(new_width) / width
+            needed = max(needed, scale)
+            width, height = new_width, new_height
+            width, height = crop_to(self.spec.width, self.spec.height)
+        if self.spec.scale:
+            new_width = int(max(width * self.spec.scale / 100.0, 1))
+            new_height = int(max(height * new_width / float(width), 1))
+            scale *= float(new_width) / width
+            needed = max(needed, scale)
+            width, height = new_width, new_height
+        for box in ((self.spec.width, None), (None, self.spec.height)):
+            if any(box):
+                new_width, new_height = fit(*box)
+                scale *= float(new_width) / width
+                needed = max(needed, scale)
+                width, height = new_width, new_height
+
+        return (width, height), min(needed or 1.0, 1.0)
+
+    def _target_scale(self):
+        """
+        The largest fraction of the source size any resize step needs (1.0 if
+        nothing shrinks it).
+        """
+        return self._plan(self.source_size)[1]
+
+    @property
+    def output_size(self):
+        """
+        (width, height) the spec will produce, worked out from the source
+        metadata without decoding it.
+        """
+        return self._plan(self.dimensions)[0]
+
+    def _draft(self, target_scale):
+        """
+        Ask the decoder for a reduced image before any filters run. The
+        decoded size is kept at least SIMPLETHUMB_REDUCING_GAP times larger
+        than target_scale (of the source size) so the final resample stays
+        accurate.
+        """
+        reducing_gap = settings.SIMPLETHUMB_REDUCING_GAP
+        if not reducing_gap:
+            return
 
-        self.stat = os.stat(image_path)
-        self.path = image_path
+        scale = target_scale * reducing_gap
+        if scale >= 1:
+            return
+
+        width, height = self.source_size
+        self.im = self.engine.draft(self.im, (int(math.ceil(width * scale)), int(math.ceil(height * scale))))
+        self.draft_scale = float(self.engine.size(self.im)[0]) / width
 
     def _resize(self, width=None, height=None):
-        orig_width, orig_height = self.pil.size
-        self.pil.thumbnail(
-            (int(width or orig_width), int(height or orig_height)),
-            PilImage.ANTIALIAS)
+        orig_width, orig_height = self.engine.size(self.im)
+        self.im = self.engine.thumbnail(self.im, (int(width or orig_width), int(height or orig_height)))
 
     def _scale(self):
-        percent = self.spec.scale
-        orig_width, orig_height = self.pil.size
+        # percent is relative to the source, not to a drafted decode
+        percent = self.spec.scale / self.draft_scale
+        orig_width, orig_height = self.engine.size(self.im)
         new_width = int(max(orig_width * (float(percent) / 100), 1))
         new_height = int(max(orig_height * new_width / orig_width, 1))
-        self.pil = self.pil.resize((new_width, new_height), PilImage.ANTIALIAS)
+        self.im = self.engine.resize(self.im, (new_width, new_height))
 
     def _width(self):
         width = self.spec.width
@@ -116,11 +445,11 @@ class Image(object):
         self._resize(height=height)
 
     def _crop_to(self, width, height):
-        img_w, img_h = self.pil.size
+        img_w, img_h = self.engine.size(self.im)
         # don't crop an image than is smaller than requested size
         if img_w <= width and img_h <= height:
             return
-        self.pil = self.pil.crop((
+        self.im = self.engine.crop(self.im, (
             (img_w - width) / 2,
             (img_h - height) / 2,
             (img_w + width) / 2,
@@ -140,7 +469,7 @@ class Image(object):
     def _crop_ratio(self):
         new_ratio = LittleFloat.unpack(self.spec.crop_ratio)
 
-        img_w, img_h = self.pil.size
+        img_w, img_h = self.engine.size(self.im)
         current_ratio = float(img_w) / img_h
 
         if current_ratio >= new_ratio:
@@ -155,9 +484,12 @@ class Image(object):
     def _image_fmt(self):
         getattr(self, '_{}'.format(Spec.FORMAT_MAP[self.spec.image_fmt]))(self.spec.formatarg)
 
+    def _format_auto(self, quality=None):
+        if self.negotiated_fmt:
+            getattr(self, '_{}'.format(Spec.FORMAT_MAP[self.negotiated_fmt]))(quality)
+
     def _format_jpeg(self, quality=None):
-        if self.pil.mode == 'RGBA':
-            self.pil = self.pil.convert('RGB')
+        self.im = self.engine.drop_alpha(self.im)
         self.image_format = 'JPEG'
         if quality:
             self.jpeg_quality = int(quality)
@@ -167,18 +499,110 @@ class Image(object):
         if optimize:
             self.optimize_png = True
 
+    def _format_webp(self, quality=None):
+        self.image_format = 'WEBP'
+        if quality:
+            self.webp_quality = int(quality)
+
+    def _format_avif(self, quality=None):
+        self.image_format = 'AVIF'
+        if quality:
+            self.avif_quality = int(quality)
+
+    @property
+    def _renditions_key(self):
+        return 'renditions:{}'.format(self.source_key)
+
+    def _find_rendition(self):
+        """
+        The smallest cached rendition of the whole source that is at least
+        SIMPLETHUMB_DERIVE_GAP times larger than this spec needs, and good
+        enough to resample: PNG, or another format saved with a quality of
+        at least SIMPLETHUMB_DERIVE_MIN_QUALITY. None if there isn't one.
+        """
+        needed = self._plan(self.dimensions)[1] * settings.SIMPLETHUMB_DERIVE_GAP
+        if needed >= 1:
+            return None
+        source_width = self.dimensions[0]
+        has_alpha = 'A' in self.metadata['mode']
+        best = None
+        for rendition in image_cache.get(self._renditions_key) or []:
+            cache_key, width, height, image_format, quality = rendition
+            if cache_key == self.cache_key or float(width) / source_width < needed:
+                continue
+            if image_format != 'PNG' and (quality or 0) < settings.SIMPLETHUMB_DERIVE_MIN_QUALITY:
+                continue
+            if has_alpha and image_format == 'JPEG':
+                continue
+            if best is None or width < best[1]:
+                best = rendition
+        return best
+
+    def _open_rendition(self):
+        """
+        Open a cached rendition found by _find_rendition instead of the
+        source, as if it were a draft decode. Returns whether there was one.
+        """
+        rendition = self._find_rendition()
+        if rendition is None:
+            return False
+        cache_key, width = rendition[:2]
+        envelope = Envelope.unpack(image_cache.get(cache_key))
+        try:
+            chunks = envelope_chunks(cache_key, envelope) if envelope is not None else None
+            image_data = b''.join(chunks) if chunks is not None else None
+        except IOError:
+            image_data = None
+        if image_data is None:
+            # evicted, wholly or in part: forget it and decode the source
+            self._drop_rendition(cache_key)
+            return False
+        self.im = self.engine.open_buffer(image_data)
+        # the output keeps the source's format unless the spec changes it
+        self.image_format = self.metadata['format']
+        self.source_size = self.dimensions
+        self.draft_scale = float(width) / self.source_size[0]
+        self.derived = True
+        metrics.incr('derived')
+        return True
+
+    def _drop_rendition(self, cache_key):
+        renditions = image_cache.get(self._renditions_key) or []
+        image_cache.set(self._renditions_key, [r for r in renditions if r[0] != cache_key])
+
+    def _add_rendition(self):
+        """
+        Note this render as a rendition others can be derived from, if it
+        is the whole source, only resized.
+        """
+        if self.derived or self.spec.crop or self.spec.crop_ratio:
+            return
+        width, height = self.rendered_size
+        rendition = (self.cache_key, width, height, self.image_format, self.save_params.get('quality'))
+        renditions = [r for r in image_cache.get(self._renditions_key) or [] if r[0] != self.cache_key]
+        renditions.append(rendition)
+        image_cache.set(self._renditions_key, renditions[-MAX_RENDITIONS:])
+
     def process_image(self):
-        self.pil = PilImage.open(self.path)
+        # engines decode lazily, so most of the decoding time shows up in the first filter
+        with metrics.timer('stage.open'):
+            if not (settings.SIMPLETHUMB_DERIVE and self._open_rendition()):
+                self.im = self.engine.open(self.path)
 
-        self.image_format = self.pil.format
+                self.image_format = self.engine.format(self.im)
+                self.source_size = self.engine.size(self.im)
+                self._draft(self._target_scale())
 
-        # force RGB
-        if self.pil.mode not in ('L', 'RGB', 'LA', 'RGBA'):
-            self.pil = self.pil.convert('RGB')
+            # force RGB
+            self.im = self.engine.normalize(self.im)
 
+        self._apply_filters()
+
+    def _apply_filters(self):
         for image_filter in self.PROCESS_ORDER:
             if getattr(self.spec, image_filter):
-                getattr(self, '_{}'.format(image_filter))()
+                with metrics.timer('stage.{}'.format(image_filter)):
+                    getattr(self, '_{}'.format(image_filter))()
 
         if self.image_format == 'JPEG':
             self.save_params['quality'] = self.jpeg_quality
@@ -186,23 +610,374 @@ class Image(object):
         if self.image_format == 'PNG':
             self.save_params['optimize'] = self.optimize_png
 
+        if self.image_format == 'WEBP':
+            self.save_params['quality'] = self.webp_quality
+
+        if self.image_format == 'AVIF':
+            self.save_params['quality'] = self.avif_quality
+
     def render(self):
         """
-        Save the image to the cache if not cached yet.
+        Save the image to the cache if not cached yet, and return its bytes.
+        """
+        return b''.join(self.render_stream())
+
+    def render_stream(self):
+        """
+        Like render(), but return the image as an iterable of byte strings.
+        Images larger than SIMPLETHUMB_CHUNK_SIZE are encoded into a
+        temporary file and cached in chunks. They are returned chunk by
+        chunk, read from the temporary file when rendered here and fetched
+        from the cache one at a time otherwise. An image with a chunk
+        missing from the cache is rendered again.
         """
+        if self.passthrough:
+            return file_chunks(open(self.path, 'rb'))
 
         if settings.SIMPLETHUMB_CACHE_ENABLED:
-            cached_image = self.cached
-            if cached_image:
-                return cached_image
+            envelope = self.cached
+            if envelope:
+                chunks = self._stream(envelope)
+                if chunks is not None:
+                    return chunks
+                # a chunk was evicted, so the entry is no use any more
+                metrics.incr('cache.chunk_evicted')
+                image_cache.delete(self.cache_key)
+
+        self.rendered_file = None
+        timeout = settings.SIMPLETHUMB_RENDER_LOCK_TIMEOUT
+        if not timeout:
+            envelope = self._render()
+        else:
+            envelope = single_flight(self.cache_key, self._render_leased, timeout)
+        if self.rendered_file is None:
+            chunks = self._stream(envelope)
+            if chunks is not None:
+                return chunks
+            # rendered by another request, and its chunks were evicted already
+            metrics.incr('cache.chunk_evicted')
+            envelope = self._render()
+        if self.rendered_file is None:
+            return self._stream(envelope)
+        # rendered here: read it back from disk rather than from the cache
+        self.envelope = envelope
+        return file_chunks(self.rendered_file)
+
+    def _stream(self, envelope):
+        """
+        The image in an Envelope from _render() or the cache, as an
+        iterable of byte strings. None if it was cached in chunks and one
+        is missing.
+        """
+        self.envelope = envelope
+        return envelope_chunks(self.cache_key, envelope)
+
+    def _render_leased(self):
+        """
+        Render while holding a lease in the cache, so that only one process
+        renders a given image at a time. Others wait for its result.
+        """
+        if not settings.SIMPLETHUMB_CACHE_ENABLED:
+            return self._render()
+
+        timeout = settings.SIMPLETHUMB_RENDER_LOCK_TIMEOUT
+        with cache_lease(image_cache, self.cache_key, timeout) as acquired:
+            if acquired:
+                # another process may have finished just before we got the lease
+                envelope = Envelope.unpack(image_cache.get(self.cache_key))
+            else:
+                envelope = Envelope.unpack(wait_for(image_cache, self.cache_key, timeout))
+            if envelope:
+                return envelope
+            return self._render()
+
+    def _encode(self, image_file):
+        """
+        Process the image and encode it into image_file.
+        """
+        with render_scheduler.slot(self.memory_cost), metrics.in_progress('renders'), \
+                profiling.trace_render(self), metrics.timer('render'):
+            self.process_image()
+            with metrics.timer('stage.encode'):
+                self.engine.save_to(self.im, self.image_format, image_file, **self.save_params)
+            self.rendered_size = self.engine.size(self.im)
+            # let go of the pixels before giving the memory back
+            self.im = None
+        metrics.observe('source_size', self.stat.st_size)
+
+    def _envelope(self, size, chunks=0, data=b''):
+        width, height = self.rendered_size
+        return Envelope(self.image_format, width, height, self.mimetype, self.etag, size, chunks, data)
+
+    def _render(self):
+        """
+        Render the image and cache it. Returns its Envelope, holding the
+        image unless it is larger than SIMPLETHUMB_CHUNK_SIZE and was cached
+        in chunks; then the image is left in rendered_file, open and
+        rewound, for the caller to read and close.
+        """
+        chunk_size = settings.SIMPLETHUMB_CHUNK_SIZE
+        width, height = self.output_size
+        # decoded size is the most an encoded image can (reasonably) take up
+        if not settings.SIMPLETHUMB_CACHE_ENABLED or width * height * 4 <= chunk_size:
+            image_file = BytesIO()
+        else:
+            image_file = tempfile.TemporaryFile()
 
-        self.process_image()
+        try:
+            self._encode(image_file)
+            size = image_file.tell()
+            metrics.observe('output_size', size)
+            image_file.seek(0)
+            if size > chunk_size and settings.SIMPLETHUMB_CACHE_ENABLED:
+                with metrics.timer('stage.cache_set'):
+                    envelope = self._cache_chunks(image_file, size)
+                image_file.seek(0)
+                self.rendered_file = image_file
+            else:
+                envelope = self._envelope(size, data=image_file.read())
+                image_file.close()
+                # Store the image data in cache
+                if settings.SIMPLETHUMB_CACHE_ENABLED:
+                    packed = envelope.pack()
+                    with metrics.timer('stage.cache_set'):
+                        image_cache.set(self.cache_key, packed)
+                    local_cache.set(self.cache_key, packed)
+        except Exception:
+            image_file.close()
+            raise
+
+        if settings.SIMPLETHUMB_DERIVE and settings.SIMPLETHUMB_CACHE_ENABLED:
+            self._add_rendition()
+        return envelope
+
+    def render_many(self, specs):
+        """
+        Render the source with each of specs, opening and decoding it once
+        for all of them (at the largest size any of them needs), and cache
+        the results with a single set_many(). Returns the images' bytes in
+        the order of specs. Images already cached are not rendered again.
+        """
+        images = [self.with_spec(spec) for spec in specs]
+        results = {}
+        cached = {}
+        if settings.SIMPLETHUMB_CACHE_ENABLED:
+            rendered = [image for image in images if not image.passthrough]
+            cached = dict(zip([image.cache_key for image in rendered], cached_many(rendered)))
+
+        pending = []
+        for image in images:
+            if image.cache_key in results:
+                continue
+            chunks = None
+            if image.passthrough:
+                chunks = [image.render()]
+            elif cached.get(image.cache_key):
+                chunks = image._stream(cached[image.cache_key])
+            if chunks is not None:
+                results[image.cache_key] = b''.join(chunks)
+            else:
+                pending.append(image)
+                # a placeholder, so a repeated spec is rendered once
+                results[image.cache_key] = None
+
+        if pending:
+            results.update(self._render_batch(pending))
+        return [results[image.cache_key] for image in images]
+
+    def _render_batch(self, images):
+        """
+        Render images, which share this image's source, from one decode and
+        cache them. Returns a dict of cache key -> bytes.
+        """
+        results = {}
+        # the shared decode, and the copy being worked on
+        with render_scheduler.slot(2 * self.memory_cost), metrics.in_progress('renders'), \
+                metrics.timer('render_many'):
+            with metrics.timer('stage.open'):
+                self._reset()
+                self.im = self.engine.open(self.path)
+                self.image_format = self.engine.format(self.im)
+                self.source_size = self.engine.size(self.im)
+                self._draft(max(image._plan(self.source_size)[1] for image in images))
+                base = self.engine.load(self.engine.normalize(self.im))
+                self.im = None
+
+            for image in images:
+                image.im = self.engine.copy(base)
+                image.image_format = self.image_format
+                image.source_size = self.source_size
+                image.draft_scale = self.draft_scale
+                image._apply_filters()
+                with metrics.timer('stage.encode'):
+                    results[image.cache_key] = self.engine.save(image.im, image.image_format, **image.save_params)
+                image.rendered_size = self.engine.size(image.im)
+                image.im = None
+                metrics.observe('output_size', len(results[image.cache_key]))
+            base = None
+        metrics.observe('source_size', self.stat.st_size)
 
-        # Store the image data in cache
-        image_str = BytesIO()
-        self.pil.save(image_str, self.image_format, **self.save_params)
-        image_data = image_str.getvalue()
         if settings.SIMPLETHUMB_CACHE_ENABLED:
-            image_cache.set(self.cache_key, image_data)
-        image_str.close()
-        return image_data
+            entries = {}
+            chunked = {}
+            chunk_size = settings.SIMPLETHUMB_CHUNK_SIZE
+            for image in images:
+                image_data = results[image.cache_key]
+                if len(image_data) > chunk_size:
+                    count = 0
+                    for start in range(0, len(image_data), chunk_size):
+                        entries['{}:{}'.format(image.cache_key, count)] = image_data[start:start + chunk_size]
+                        count += 1
+                    chunked[image.cache_key] = image._envelope(len(image_data), chunks=count).pack()
+                else:
+                    entries[image.cache_key] = image._envelope(len(image_data), data=image_data).pack()
+                    local_cache.set(image.cache_key, entries[image.cache_key])
+            # chunked entries go last, after their chunks
+            entries.update(chunked)
+            with metrics.timer('stage.cache_set'):
+                image_cache.set_many(entries)
+            if settings.SIMPLETHUMB_DERIVE:
+                for image in images:
+                    image._add_rendition()
+        return results
+
+    def _cache_chunks(self, image_file, size):
+        chunk_size = settings.SIMPLETHUMB_CHUNK_SIZE
+        count = 0
+        for chunk in iter(lambda: image_file.read(chunk_size), b''):
+            image_cache.set('{}:{}'.format(self.cache_key, count), chunk)
+            count += 1
+        # written last, so readers never find an incomplete image
+        envelope = self._envelope(size, chunks=count)
+        image_cache.set(self.cache_key, envelope.pack())
+        return envelope
+
+    def store(self):
+        """
+        Write the rendered image under SIMPLETHUMB_STORAGE_ROOT if it isn't
+        there yet, and return its path.
+        """
+        path = self.stored_path
+        if os.path.exists(path):
+            return path
+
+        timeout = settings.SIMPLETHUMB_RENDER_LOCK_TIMEOUT
+        if not timeout:
+            return self._store()
+        return single_flight(path, self._store, timeout)
+
+    def _store(self):
+        path = self.stored_path
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write to a temporary file and rename it, so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                if settings.SIMPLETHUMB_CACHE_ENABLED or self.passthrough:
+                    for chunk in self.render_stream():
+                        tmp_file.write(chunk)
+                else:
+                    # nothing to share the render with, so encode straight to disk
+                    self._encode(tmp_file)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        # mkstemp creates files readable by the owner only; the front-end server needs to read it
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+        return path
+
+
+def cached_many(images):
+    """
+    The cached Envelopes of images (None for those not cached), in order.
+    Those not in the local cache are fetched with one get_many().
+    """
+    values = {}
+    missing = []
+    for image in images:
+        if image.cache_key in values or image.cache_key in missing:
+            continue
+        value = local_cache.get(image.cache_key)
+        if value is not None:
+            metrics.incr('cache.local_hit')
+            values[image.cache_key] = value
+        else:
+            missing.append(image.cache_key)
+
+    if missing:
+        found = image_cache.get_many(missing)
+        for key in missing:
+            envelope = Envelope.unpack(found.get(key))
+            if envelope is not None and not envelope.chunks:
+                local_cache.set(key, found[key])
+            metrics.incr('cache.hit' if envelope is not None else 'cache.miss')
+        values.update(found)
+    return [Envelope.unpack(values.get(image.cache_key)) for image in images]
+
+
+def envelope_chunks(cache_key, envelope):
+    """
+    The image in an Envelope as an iterable of byte strings. Chunks are
+    fetched one at a time as they are read, after checking they are all
+    still cached, so a missing one is noticed before any are used. None
+    if any was evicted.
+    """
+    if not envelope.chunks:
+        return [envelope.data]
+    keys = ['{}:{}'.format(cache_key, index) for index in range(envelope.chunks)]
+    if not all(image_cache.has_key(key) for key in keys):
+        return None
+    return cached_chunks(keys)
+
+
+def cached_chunks(keys):
+    """
+    Fetch the chunks under keys one at a time. Raises IOError should one
+    be evicted while they are read.
+    """
+    for key in keys:
+        chunk = image_cache.get(key)
+        if chunk is None:
+            raise IOError('{} was evicted from the cache while it was read'.format(key))
+        yield chunk
+
+
+def file_chunks(image_file):
+    """
+    Read a file in chunks of SIMPLETHUMB_CHUNK_SIZE, closing it at the end.
+    """
+    chunk_size = settings.SIMPLETHUMB_CHUNK_SIZE
+    try:
+        while True:
+            chunk = image_file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        image_file.close()
+
+
+def accepted_types(accept):
+    """
+    The media types listed in an Accept header, minus any with q=0.
+    """
+    types = set()
+    for item in (accept or '').split(','):
+        params = item.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > 0:
+            types.add(params[0].strip().lower())
+    return types
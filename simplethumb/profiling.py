@@ -0,0 +1,154 @@
+"""
+Per-render traces for finding the sources that are expensive to render.
+
+A trace describes one render: the source (path, size, mode, format), the
+spec, the time taken by each stage and in total, the estimated pixel
+memory and, with SIMPLETHUMB_TRACE_MEMORY, the peak of Python allocations
+seen by tracemalloc. That peak is process-wide: with renders running at
+the same time, it covers all of them, from when the first one started. Traces of renders slower than
+SIMPLETHUMB_SLOW_RENDER_THRESHOLD are logged, and every trace is passed to
+SIMPLETHUMB_RENDER_TRACE_HOOK if one is set. A sample of renders can also
+be run under cProfile, with the stats written to SIMPLETHUMB_PROFILE_DIR.
+"""
+import cProfile
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from simplethumb import metrics
+from simplethumb.conf import settings
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+logger = logging.getLogger('simplethumb')
+
+# renders measuring memory right now, and whether tracemalloc was started for them
+_memory_lock = threading.Lock()
+_memory_renders = 0
+_started_tracing = False
+
+
+def enabled():
+    return (settings.SIMPLETHUMB_SLOW_RENDER_THRESHOLD is not None or settings.SIMPLETHUMB_RENDER_TRACE_HOOK
+            or settings.SIMPLETHUMB_TRACE_MEMORY or settings.SIMPLETHUMB_PROFILE_SAMPLE_RATE)
+
+
+@contextmanager
+def trace_render(image):
+    """
+    Trace the render of image run in the block.
+    """
+    if not enabled():
+        yield
+        return
+
+    trace_memory = settings.SIMPLETHUMB_TRACE_MEMORY and tracemalloc is not None
+    if trace_memory:
+        start_memory_trace()
+
+    profiler = None
+    if random.random() < settings.SIMPLETHUMB_PROFILE_SAMPLE_RATE:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already running
+            profiler = None
+
+    start = time.time()
+    try:
+        with metrics.record_timings() as timings:
+            yield
+    finally:
+        duration = time.time() - start
+        if profiler is not None:
+            profiler.disable()
+        peak_memory = None
+        if trace_memory:
+            peak_memory = stop_memory_trace()
+
+    trace = {
+        'path': image.path,
+        'spec': dict((attr, image.spec.attrs.get(attr, True))
+                     for attr, value in image.spec.flags.items() if value),
+        'width': image.metadata['width'],
+        'height': image.metadata['height'],
+        'mode': image.metadata['mode'],
+        'format': image.metadata['format'],
+        'source_size': image.stat.st_size,
+        'duration': duration,
+        'stages': timings,
+        'estimated_memory': image.memory_cost,
+        'peak_python_memory': peak_memory,
+    }
+    if profiler is not None:
+        trace['profile'] = dump_profile(profiler, image)
+
+    threshold = settings.SIMPLETHUMB_SLOW_RENDER_THRESHOLD
+    if threshold is not None and duration > threshold:
+        logger.warning('Slow render of %s (%dx%d %s %s) with %r took %.3fs: %s', trace['path'], trace['width'],
+                       trace['height'], trace['mode'], trace['format'], trace['spec'], duration,
+                       ', '.join('{} {:.3f}s'.format(name, seconds) for name, seconds in timings),
+                       extra={'trace': trace})
+    if settings.SIMPLETHUMB_RENDER_TRACE_HOOK:
+        import_string(settings.SIMPLETHUMB_RENDER_TRACE_HOOK)(trace)
+
+
+def start_memory_trace():
+    """
+    Start measuring the peak of Python allocations for a render. The
+    peak is process-wide: the first of several overlapping renders resets
+    it, and none of them resets it or stops tracing while another still
+    measures.
+    """
+    global _memory_renders, _started_tracing
+    with _memory_lock:
+        if not _memory_renders:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _started_tracing = True
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # python < 3.9 can only reset the peak along with the traces
+                tracemalloc.clear_traces()
+        _memory_renders += 1
+
+
+def stop_memory_trace():
+    """
+    Finish measuring a render's memory, and return the peak seen since
+    the first of the renders measuring at the same time started.
+    """
+    global _memory_renders, _started_tracing
+    with _memory_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _memory_renders -= 1
+        if not _memory_renders and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+    return peak
+
+
+def dump_profile(profiler, image):
+    """
+    Write the profiler's stats to SIMPLETHUMB_PROFILE_DIR, returning the
+    path, or None if no directory is set.
+    """
+    directory = settings.SIMPLETHUMB_PROFILE_DIR
+    if not directory:
+        return None
+    digest = hashlib.sha1(image.cache_key.encode()).hexdigest()[:12]
+    path = os.path.join(directory, '{}-{}.prof'.format(int(time.time() * 1000), digest))
+    profiler.dump_stats(path)
+    return path
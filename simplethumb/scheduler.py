@@ -0,0 +1,90 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from simplethumb.conf import settings
+
+
+class RenderQueueTimeout(Exception):
+    pass
+
+
+class RenderScheduler(object):
+    """
+    Limits the memory taken by renders running at the same time in this
+    process. Each render declares its estimated cost in bytes and waits
+    until it fits within SIMPLETHUMB_RENDER_MEMORY; waiting renders are
+    admitted cheapest first. A render costing more than the whole budget
+    is admitted once nothing else is running. Gives up with
+    RenderQueueTimeout after SIMPLETHUMB_RENDER_QUEUE_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting = []  # heap of (cost, sequence)
+        self._sequence = itertools.count()
+        self.memory = 0
+        self.running = 0
+        self.admitted = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    @contextmanager
+    def slot(self, cost):
+        budget = settings.SIMPLETHUMB_RENDER_MEMORY
+        if not budget:
+            yield
+            return
+
+        entry = (cost, next(self._sequence))
+        start = time.time()
+        deadline = start + settings.SIMPLETHUMB_RENDER_QUEUE_TIMEOUT
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while not (self._waiting[0] is entry and (not self.running or self.memory + cost <= budget)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self.timeouts += 1
+                    # a cheaper render may now be at the head of the queue
+                    self._cond.notify_all()
+                    raise RenderQueueTimeout()
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self.memory += cost
+            self.running += 1
+            self.admitted += 1
+            waited = time.time() - start
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            # the next in line may fit as well
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.memory -= cost
+                self.running -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'queued': self.queue_depth,
+            'running': self.running,
+            'memory': self.memory,
+            'admitted': self.admitted,
+            'timeouts': self.timeouts,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
+
+
+render_scheduler = RenderScheduler()
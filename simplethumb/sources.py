@@ -0,0 +1,163 @@
+"""
+Sources kept in a Django storage (SIMPLETHUMB_SOURCE_STORAGE) rather than
+on the local filesystem.
+
+The engines need a local file, so sources are fetched into a directory of
+local copies, keyed on their name and modified time. It is shared by the
+processes using it and bounded in size, dropping the least recently used
+copies first.
+"""
+import calendar
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from simplethumb import metrics
+from simplethumb.conf import settings
+from simplethumb.locks import single_flight
+
+# the part of os.stat()'s result simplethumb uses, for sources in a storage
+SourceStat = namedtuple('SourceStat', ['st_mtime', 'st_size'])
+
+TMP_PREFIX = '.tmp'
+
+_storage = (None, None)  # (SIMPLETHUMB_SOURCE_STORAGE it was made for, storage)
+_storage_lock = threading.Lock()
+
+
+def get_source_storage():
+    global _storage
+    backend = settings.SIMPLETHUMB_SOURCE_STORAGE
+    if not backend:
+        return None
+    if _storage[0] != backend:
+        with _storage_lock:
+            if _storage[0] != backend:
+                _storage = (backend, import_string(backend)())
+    return _storage[1]
+
+
+def storage_stat(storage, name):
+    """
+    Modified time (as a timestamp) and size of a file in a storage. Raises
+    OSError if there is no such file. Each storage raises its own error for
+    a missing file, so whether it exists is only asked once one fails.
+    """
+    # get_modified_time arrived in Django 1.10
+    modified_time = getattr(storage, 'get_modified_time', None) or storage.modified_time
+    try:
+        modified = modified_time(name)
+        size = storage.size(name)
+    except Exception:
+        if not storage.exists(name):
+            raise OSError(errno.ENOENT, 'No such file in storage', name)
+        raise
+    if timezone.is_aware(modified):
+        timestamp = calendar.timegm(modified.utctimetuple())
+    else:
+        timestamp = time.mktime(modified.timetuple())
+    return SourceStat(timestamp + modified.microsecond / 1000000.0, size)
+
+
+class SourceFileCache(object):
+    """
+    Local copies of sources from a storage, in SIMPLETHUMB_SOURCE_CACHE_DIR.
+    Once they take up more than SIMPLETHUMB_SOURCE_CACHE_SIZE bytes, the
+    least recently used are removed.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.fetches = 0
+
+    @property
+    def directory(self):
+        return settings.SIMPLETHUMB_SOURCE_CACHE_DIR or os.path.join(tempfile.gettempdir(), 'simplethumb-sources')
+
+    def local_path(self, name, mtime):
+        digest = hashlib.sha1(u'{}:{}'.format(name, mtime).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + os.path.splitext(name)[1])
+
+    def fetch(self, storage, name, mtime):
+        """
+        Path of a local copy of name, fetching it from storage if needed.
+        """
+        path = self.local_path(name, mtime)
+        try:
+            # the modification time of a copy is when it was last used
+            os.utime(path, None)
+            self.hits += 1
+            return path
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        timeout = settings.SIMPLETHUMB_RENDER_LOCK_TIMEOUT
+        if not timeout:
+            return self._fetch(storage, name, path)
+        return single_flight(path, lambda: self._fetch(storage, name, path), timeout)
+
+    def _fetch(self, storage, name, path):
+        if os.path.exists(path):
+            return path
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write to a temporary file and rename it, so readers never see a partial copy
+        fd, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file, storage.open(name, 'rb') as source:
+                for chunk in source.chunks():
+                    tmp_file.write(chunk)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, path)
+        self.fetches += 1
+        metrics.incr('source_fetch')
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used copies until the rest fit within
+        SIMPLETHUMB_SOURCE_CACHE_SIZE. Never removes keep.
+        """
+        entries = []
+        total = 0
+        for entry_name in os.listdir(self.directory):
+            if entry_name.startswith(TMP_PREFIX):
+                continue
+            entry_path = os.path.join(self.directory, entry_name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total += stat.st_size
+
+        entries.sort()
+        max_size = settings.SIMPLETHUMB_SOURCE_CACHE_SIZE
+        for mtime, size, entry_path in entries:
+            if total <= max_size:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+
+
+source_cache = SourceFileCache()
@@ -3,15 +3,26 @@ import binascii
 import codecs
 import hashlib
 import hmac
+import logging
+import math
 import re
 import struct
 
-from itertools import cycle
+logger = logging.getLogger('simplethumb')
 
-try:
-    from itertools import izip as zip
-except ImportError:
-    pass
+if hasattr(int, 'from_bytes'):
+    def int_from_bytes(data):
+        return int.from_bytes(data, 'big')
+
+    def int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+else:
+    # python 2
+    def int_from_bytes(data):
+        return int(binascii.hexlify(data) or '0', 16)
+
+    def int_to_bytes(value, length):
+        return binascii.unhexlify('{0:0{1}x}'.format(value, length * 2))
 
 
 class ChecksumException(Exception):
@@ -31,6 +42,9 @@ class LittleFloat(object):
     EXP_BITS = 4
     SIZE = MANT_BITS + EXP_BITS + 1
 
+    MANT_MASK = 2 ** MANT_BITS - 1
+    EXP_MASK = 2 ** EXP_BITS - 1
+
     @classmethod
     def pack(cls, num):
         num = float(num)
@@ -39,49 +53,68 @@ class LittleFloat(object):
             return 32768
         if num == 0:
             return 0
-        integral = int(num)
-        dec = num - integral
-        int_bin = '{0:b}'.format(integral) if integral > 0 else ''
-        mantissa = int_bin
-        for idx in range(cls.MANT_BITS - len(int_bin) + 1):
-            if dec == 0:
-                break
-            next_val = float(dec * cls.BASE)
-            next_bit = int(next_val)
-            mantissa += str(next_bit)
-            dec = next_val - next_bit
+        if num < 0:
+            raise ValueError('Cannot pack negative number {}'.format(num))
 
+        integral = int(num)
         if integral:
-            exp = len(int_bin) - 1
-            sign = '0'
-        else:
-            exp = mantissa.find('1') + 1
-            sign = '1'
-            if exp == -1:
+            # the integral bits followed by as many fractional bits as fit, truncated
+            exp = integral.bit_length() - 1
+            if exp > cls.EXP_MASK:
                 raise ValueError('Not enough precision {}'.format(num))
-            mantissa = mantissa[exp - 1:]
+            mantissa = int(math.ldexp(num, cls.MANT_BITS - exp)) & cls.MANT_MASK
+            return (exp << cls.MANT_BITS) | mantissa
 
-        if exp >= (cls.BASE ** cls.EXP_BITS):
-            raise ValueError('Not enough precision {}'.format(num))
-
-        bin_str = sign + '{0:b}'.format(exp).zfill(cls.EXP_BITS)[:cls.EXP_BITS] \
-                  + mantissa[1:].ljust(cls.MANT_BITS, '0')[:cls.MANT_BITS]
-
-        return int(bin_str, cls.BASE)
+        # only the first MANT_BITS + 1 fractional bits are looked at; the
+        # bits after the leading one are left aligned in the mantissa
+        fraction = int(math.ldexp(num, cls.MANT_BITS + 1))
+        if not fraction:
+            return 32768
+        exp = cls.MANT_BITS + 2 - fraction.bit_length()
+        mantissa = (fraction << (exp - 1)) & cls.MANT_MASK
+        return (1 << (cls.SIZE - 1)) | (exp << cls.MANT_BITS) | mantissa
 
     @classmethod
     def unpack(cls, packed):
-        bin_str = '{0:b}'.format(packed)[-cls.SIZE:].zfill(cls.SIZE)
-        sign = int(bin_str[0])
-        exp = int(bin_str[1:cls.EXP_BITS + 1], cls.BASE)
+        sign = (packed >> (cls.SIZE - 1)) & 1
+        exp = (packed >> cls.MANT_BITS) & cls.EXP_MASK
         if sign:
             exp *= -1
-        mantissa = '1' + bin_str[1 + cls.EXP_BITS:]
-        number = float()
-        for idx in range(len(mantissa)):
-            if mantissa[idx:idx + 1] == '1':
-                number += cls.BASE ** (exp - idx)
-        return number
+        mantissa = (1 << cls.MANT_BITS) | (packed & cls.MANT_MASK)
+        return math.ldexp(mantissa, exp - cls.MANT_BITS)
+
+
+def _compile_token_spec(token_spec):
+    """
+    Combine the token patterns into a single anchored regex with one named
+    group per token. Returns the regex and a map of token key to
+    (position in token_spec, index of its first argument in groups(),
+    number of arguments).
+    """
+    alternatives = []
+    groups = {}
+    group_index = 0
+    for order, (token_key, pattern) in enumerate(token_spec):
+        count = re.compile(pattern).groups
+        alternatives.append('(?P<{}>{})'.format(token_key, pattern))
+        groups[token_key] = (order, group_index + 1, count)
+        group_index += 1 + count
+    return re.compile('^(?:{})$'.format('|'.join(alternatives))), groups
+
+
+def _header_layout(header_fmt, attr_formats):
+    """
+    Precompute, for each header flag: its bit position and largest value,
+    and the size and largest value of the attribute stored in the body when
+    the flag is set (0 if it has none).
+    """
+    layout = []
+    header_pos = 0
+    for attr, size in header_fmt:
+        attr_size = attr_formats.get(attr, 0)
+        layout.append((attr, header_pos, 2 ** size - 1, attr_size, 2 ** attr_size - 1))
+        header_pos += size
+    return layout
 
 
 class Spec(object):
@@ -91,6 +124,9 @@ class Spec(object):
 
     TOKEN_FORMAT_JPEG = 'format_jpeg'
     TOKEN_FORMAT_PNG = 'format_png'
+    TOKEN_FORMAT_WEBP = 'format_webp'
+    TOKEN_FORMAT_AVIF = 'format_avif'
+    TOKEN_FORMAT_AUTO = 'format_auto'
     TOKEN_CROP = 'crop'
     TOKEN_SCALE = 'scale'
     TOKEN_RESIZE = 'resize'
@@ -104,27 +140,41 @@ class Spec(object):
 
     TOKEN_SPEC = [
         # token key, string match, kwarg match
-        (TOKEN_FORMAT_JPEG, 'jpe?g(\d*)'),
-        (TOKEN_FORMAT_PNG, 'png([Oo])?'),
-        (TOKEN_CROP, '(\d+)x(\d+),[Cc]'),
-        (TOKEN_SCALE, '(\d+)\%'),
-        (TOKEN_RESIZE, '(\d+)x(\d+)'),
-        (TOKEN_WIDTH, '(\d+)x'),
-        (TOKEN_HEIGHT, 'x(\d+)'),
-        (TOKEN_CROP_RATIO, '[Cc](\d+):(\d+)')
+        (TOKEN_FORMAT_JPEG, r'jpe?g(\d*)'),
+        (TOKEN_FORMAT_PNG, r'png([Oo])?'),
+        (TOKEN_FORMAT_WEBP, r'webp(\d*)'),
+        (TOKEN_FORMAT_AVIF, r'avif(\d*)'),
+        (TOKEN_FORMAT_AUTO, r'auto(\d*)'),
+        (TOKEN_CROP, r'(\d+)x(\d+),[Cc]'),
+        (TOKEN_SCALE, r'(\d+)\%'),
+        (TOKEN_RESIZE, r'(\d+)x(\d+)'),
+        (TOKEN_WIDTH, r'(\d+)x'),
+        (TOKEN_HEIGHT, r'x(\d+)'),
+        (TOKEN_CROP_RATIO, r'[Cc](\d+):(\d+)')
     ]
+    # All of TOKEN_SPEC as one regex, plus where each token's arguments sit in match.groups()
+    TOKEN_RE, TOKEN_GROUPS = _compile_token_spec(TOKEN_SPEC)
 
     FORMAT_UNDEF = 0
     FORMAT_PNG = 1
     FORMAT_JPEG = 2
+    FORMAT_WEBP = 3
+    FORMAT_AVIF = 4
+    # picked per request from the formats the client accepts
+    FORMAT_AUTO = 5
 
     FORMAT_MAP = {
         FORMAT_PNG: TOKEN_FORMAT_PNG,
         FORMAT_JPEG: TOKEN_FORMAT_JPEG,
+        FORMAT_WEBP: TOKEN_FORMAT_WEBP,
+        FORMAT_AVIF: TOKEN_FORMAT_AVIF,
+        FORMAT_AUTO: TOKEN_FORMAT_AUTO,
     }
     FORMAT_EXT_MAP = {
         FORMAT_JPEG: 'jpg',
         FORMAT_PNG: 'png',
+        FORMAT_WEBP: 'webp',
+        FORMAT_AVIF: 'avif',
     }
 
     HEADER_FMT = [
@@ -149,6 +199,10 @@ class Spec(object):
         TOKEN_FORMATARG: 7,
         TOKEN_CROP_RATIO: 16,
     }
+    HEADER_LAYOUT = _header_layout(HEADER_FMT, ATTR_FORMATS)
+
+    #: encoded specs are at least this many bytes, not counting the checksum
+    MIN_SPEC_BYTES = 4
 
     def __init__(self, flags, attrs):
         self.flags = flags
@@ -169,34 +223,24 @@ class Spec(object):
         else:
             return attr
 
-    @staticmethod
-    def _check_val(value, size):
-        if value > 2 ** size - 1:
-            value = 2 ** size - 1
-        return value
-
     @staticmethod
     def make_checksum(specbytes):
-        return struct.pack('B', sum(map(ord_compat, specbytes)) % 255)
+        return struct.pack('B', sum(bytearray(specbytes)) % 255)
 
     def encode(self):
         packed_int = 0
-        header_pos = 0
         body_pos = self.HEADER_LENGTH
 
-        for attr, size in self.HEADER_FMT:
-            value = self._check_val(int(self.flags.get(attr, 0)), size)
-            packed_int += (value << header_pos)
-            header_pos += size
-            if value and attr in self.ATTR_FORMATS.keys():
-                attr_val = int(self.attrs.get(attr, 0))
-                attr_val_size = self.ATTR_FORMATS[attr]
-                attr_val = self._check_val(attr_val, attr_val_size)
-                packed_int += (attr_val << body_pos)
-                body_pos += attr_val_size
-
-        hex_str = format(packed_int, 'x').zfill(8)  # Pad to at least 4 bytes
-        specbytes = binascii.unhexlify(('0' * (len(hex_str) % 2)) + hex_str)
+        for attr, header_pos, header_max, attr_size, attr_max in self.HEADER_LAYOUT:
+            value = min(int(self.flags.get(attr, 0)), header_max)
+            if not value:
+                continue
+            packed_int |= value << header_pos
+            if attr_size:
+                packed_int |= min(int(self.attrs.get(attr, 0)), attr_max) << body_pos
+                body_pos += attr_size
+
+        specbytes = int_to_bytes(packed_int, max(self.MIN_SPEC_BYTES, (packed_int.bit_length() + 7) // 8))
         checksum = self.make_checksum(specbytes)
         return checksum + specbytes
 
@@ -206,35 +250,34 @@ class Spec(object):
         checksum = cls.make_checksum(specbytes)
         if checksum != checkbyte:
             raise ChecksumException
-        packed_int = int(binascii.hexlify(specbytes), 16)
+        packed_int = int_from_bytes(specbytes)
         flags_dict = {}
         attrs_dict = {}
-        header_pos = 0
         body_pos = cls.HEADER_LENGTH
-        for attr, size in cls.HEADER_FMT:
-            mask = (2 ** size - 1 << header_pos)
-            value = (packed_int & mask) >> header_pos
-            if value:
-                flags_dict[attr] = bool(value)
-            header_pos += size
-            if value and attr in cls.ATTR_FORMATS.keys():
-                attr_val_size = cls.ATTR_FORMATS[attr]
-                mask = (2 ** attr_val_size - 1 << body_pos)
-                attrs_dict[attr] = (packed_int & mask) >> body_pos
-                body_pos += attr_val_size
+        for attr, header_pos, header_max, attr_size, attr_max in cls.HEADER_LAYOUT:
+            if not (packed_int >> header_pos) & header_max:
+                continue
+            flags_dict[attr] = True
+            if attr_size:
+                attrs_dict[attr] = (packed_int >> body_pos) & attr_max
+                body_pos += attr_size
         return cls(flags_dict, attrs_dict)
 
     @classmethod
     def from_string(cls, filter_string):
         applied_filters = []
-        tokens = filter_string.split()
-        for preset_key, spec in cls.TOKEN_SPEC:
-            r = re.compile("^{}$".format(spec))
-            applied_filters += list(map(lambda t: (preset_key, r.match(t)), tokens))
-        applied_filters = [(f[0], f[1].groups()) for f in applied_filters if f[1]]
+        for token in filter_string.split():
+            match = cls.TOKEN_RE.match(token)
+            if match is None:
+                logger.warning('Ignoring unknown token %r in spec %r', token, filter_string)
+                continue
+            order, start, count = cls.TOKEN_GROUPS[match.lastgroup]
+            applied_filters.append((order, match.lastgroup, match.groups()[start:start + count]))
+        # apply tokens in TOKEN_SPEC order, as before, so later tokens win in the same way
+        applied_filters.sort(key=lambda f: f[0])
         attrs_dict = {}
         flags_dict = {}
-        for filterkey, args in applied_filters:
+        for order, filterkey, args in applied_filters:
             if filterkey == cls.TOKEN_WIDTH:
                 flags_dict[cls.TOKEN_WIDTH] = True
                 attrs_dict[cls.TOKEN_WIDTH] = int(args[0])
@@ -264,6 +307,16 @@ class Spec(object):
                 if args[0]:
                     flags_dict[cls.TOKEN_FORMATARG] = True
                     attrs_dict[cls.TOKEN_FORMATARG] = bool(args[0])
+            elif filterkey in (cls.TOKEN_FORMAT_WEBP, cls.TOKEN_FORMAT_AVIF, cls.TOKEN_FORMAT_AUTO):
+                flags_dict[cls.TOKEN_IMAGEFMT] = True
+                attrs_dict[cls.TOKEN_IMAGEFMT] = {
+                    cls.TOKEN_FORMAT_WEBP: cls.FORMAT_WEBP,
+                    cls.TOKEN_FORMAT_AVIF: cls.FORMAT_AVIF,
+                    cls.TOKEN_FORMAT_AUTO: cls.FORMAT_AUTO,
+                }[filterkey]
+                if args[0]:
+                    flags_dict[cls.TOKEN_FORMATARG] = True
+                    attrs_dict[cls.TOKEN_FORMATARG] = args[0]
             elif filterkey == cls.TOKEN_SCALE:
                 flags_dict[cls.TOKEN_SCALE] = True
                 attrs_dict[cls.TOKEN_SCALE] = int(args[0])
@@ -279,26 +332,39 @@ def calc_hmac(data, key):
     return mac.digest()
 
 
+def spec_signature(basename, mtime, hmac_key='DEFAULT_KEY'):
+    """
+    The key specs for this source are XORed with. Depends only on the
+    source, so it can be computed once for several specs.
+    """
+    return calc_hmac(basename + str(mtime), hmac_key)
+
+
 def decode_spec(data, basename, mtime, hmac_key='DEFAULT_KEY'):
     padding_needed = len(data) % 4
     if padding_needed != 0:
         data += '=' * (4 - padding_needed)
     decoded = base64.urlsafe_b64decode(str(data))
-    sig = calc_hmac(basename + str(mtime), hmac_key)
+    sig = spec_signature(basename, mtime, hmac_key)
     spec = xor_crypt_string(decoded, sig)
     return spec
 
 
-def encode_spec(data, basename, mtime, hmac_key='DEFAULT_KEY'):
-    sig = calc_hmac(basename + str(mtime), hmac_key)
+def encode_spec(data, basename, mtime, hmac_key='DEFAULT_KEY', sig=None):
+    if sig is None:
+        sig = spec_signature(basename, mtime, hmac_key)
     spec = bytes(xor_crypt_string(data, sig))
     encoded_spec = base64.urlsafe_b64encode(spec).decode().rstrip('=')
     return encoded_spec
 
 
 def xor_crypt_string(data, key):
-    # Borrowed from https://stackoverflow.com/questions/11132714/python-two-way-alphanumeric-encryption
-    return bytearray([ord_compat(x) ^ ord_compat(y) for (x, y) in zip(data, cycle(key))])
+    # XOR data with key repeated to its length, as one big integer operation
+    length = len(data)
+    if not length:
+        return bytearray()
+    key = bytes(key) * (length // len(key) + 1)
+    return bytearray(int_to_bytes(int_from_bytes(bytes(data)) ^ int_from_bytes(key[:length]), length))
 
 
 def ord_compat(byte):
@@ -1,9 +1,11 @@
 import six
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.fields.files import ImageFieldFile
 from django.template import Library
 
-from simplethumb.spec import encode_spec
+from simplethumb.cache import Memo
+from simplethumb.spec import encode_spec, spec_signature
 from ..models import Image
 
 try:
@@ -13,6 +15,45 @@ except ImportError:
 
 register = Library()
 
+# (basename, spec string, mtime) -> url
+_url_memo = Memo()
+
+
+def _source_url(value):
+    if isinstance(value, ImageFieldFile):
+        if settings.SIMPLETHUMB_SOURCE_STORAGE:
+            # looked up by name in the storage
+            return value.name
+        return value.url
+    elif isinstance(value, six.string_types):
+        # A string is assumed to be a static file using django's staticfiles app
+        return value
+    raise AttributeError("value is not a valid static image or ImageField")
+
+
+def _thumbnail_url(image, spec, sig=None):
+    """
+    Url of image rendered with spec. sig may be passed in to save
+    recomputing the HMAC when making several urls for one image.
+    """
+    image.spec = spec
+    memo_key = (image.basename, spec, image.mtime) if isinstance(spec, six.string_types) else None
+    thumb_url = _url_memo.get(memo_key)
+    if thumb_url is None:
+        if not image.format_supported:
+            raise ImproperlyConfigured('{} cannot write the format asked for by "{}"'.format(
+                type(image.engine).__name__, spec))
+        encoded_spec = encode_spec(image.spec.encoded, image.basename, image.mtime, settings.SIMPLETHUMB_HMAC_KEY,
+                                   sig=sig)
+        thumb_url = reverse('simplethumb', kwargs={
+            'basename': image.basename,
+            'encoded_spec': encoded_spec,
+            'ext': image.ext,
+        })
+        if memo_key is not None:
+            _url_memo[memo_key] = thumb_url
+    return thumb_url
+
 
 @register.simple_tag
 def simplethumb(value, spec=''):
@@ -20,20 +61,46 @@ def simplethumb(value, spec=''):
     Generates the url for the resized image prefixing with prefix_path
     return string url
     """
+    image = Image(url=_source_url(value), source_max_age=settings.SIMPLETHUMB_SOURCE_CACHE_TIMEOUT)
+    return _thumbnail_url(image, spec)
 
-    if isinstance(value, ImageFieldFile):
-        url = value.url
-    elif isinstance(value, six.string_types):
-        # A string is assumed to be a static file using django's staticfiles app
-        url = value
-    else:
-        raise AttributeError("value is not a valid static image or ImageField")
-
-    image = Image(url=url, spec=spec)
-    encoded_spec = encode_spec(image.spec.encoded, image.basename, image.mtime, settings.SIMPLETHUMB_HMAC_KEY)
-
-    return reverse('simplethumb', kwargs={
-        'basename': image.basename,
-        'encoded_spec': encoded_spec,
-        'ext': image.ext,
-    })
+
+@register.simple_tag
+def simplethumb_srcset(value, widths, spec=''):
+    """
+    Generates a srcset attribute value with one url per width in widths
+    (e.g. "400x 800x 1200x"), each rendered with spec as well. Widths
+    larger than the source are left out in favour of the source's own width.
+    Each url is described by the width it renders at, which a crop or a
+    height in spec can make narrower; urls that render at the same width
+    as a smaller one are left out.
+    """
+    image = Image(url=_source_url(value), source_max_age=settings.SIMPLETHUMB_SOURCE_CACHE_TIMEOUT)
+    sig = spec_signature(image.basename, image.mtime, settings.SIMPLETHUMB_HMAC_KEY)
+    source_width = image.dimensions[0]
+
+    widths = sorted(set(int(width.rstrip('xXwW')) for width in widths.split()))
+    if widths and widths[-1] > source_width:
+        widths = [width for width in widths if width < source_width] + [source_width]
+
+    candidates = []
+    rendered_widths = set()
+    for width in widths:
+        width_spec = ' '.join(['{}x'.format(width), spec]).strip()
+        rendered_width = image.with_spec(width_spec).output_size[0]
+        if rendered_width in rendered_widths:
+            continue
+        rendered_widths.add(rendered_width)
+        candidates.append('{} {}w'.format(_thumbnail_url(image, width_spec, sig), rendered_width))
+    return ', '.join(candidates)
+
+
+@register.simple_tag
+def simplethumb_size(value, spec=''):
+    """
+    The (width, height) the thumbnail for value and spec will have, for
+    width and height attributes. Only reads the source image's header.
+    e.g. {% simplethumb_size image "200x" as size %}
+    """
+    image = Image(url=_source_url(value), spec=spec, source_max_age=settings.SIMPLETHUMB_SOURCE_CACHE_TIMEOUT)
+    return image.output_size
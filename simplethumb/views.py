@@ -1,43 +1,214 @@
 import mimetypes
+import os
 import time
 
-from django.http import HttpResponse, Http404, HttpResponseNotModified
+from django.http import FileResponse, HttpResponse, Http404, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.http import http_date
 from django.views.static import was_modified_since
 
 from django.conf import settings
-from simplethumb.models import Image
+from simplethumb import metrics
+from simplethumb.models import Image, cached_many
+from simplethumb.scheduler import RenderQueueTimeout
 from simplethumb.spec import Spec, ChecksumException, decode_spec
 
 
-# noinspection PyUnusedLocal
-def serve_image(request, basename, encoded_spec, ext):
+def file_response(path, mimetype, internal_url=None):
+    """
+    Respond with the file at path, letting the front-end server send it
+    when a sendfile backend is configured. X-Accel-Redirect needs the
+    internal url the file is aliased at.
+    """
+    backend = settings.SIMPLETHUMB_SENDFILE_BACKEND
+    if backend == 'x-accel-redirect' and internal_url:
+        resp = HttpResponse(content_type=mimetype)
+        resp['X-Accel-Redirect'] = internal_url
+    elif backend == 'x-sendfile':
+        resp = HttpResponse(content_type=mimetype)
+        resp['X-Sendfile'] = path
+    else:
+        resp = FileResponse(open(path, 'rb'), content_type=mimetype)
+    return resp
+
+
+def envelope_response(envelope):
+    """
+    Respond with an image cached whole, using the headers cached with it.
+    """
+    resp = HttpResponse(envelope.data, envelope.mimetype)
+    resp['ETag'] = envelope.etag
+    return resp
+
+
+def rendered_response(image, mimetype):
+    """
+    Respond with the rendered image, streaming it if it is cached in chunks.
+    """
+    chunks = image.render_stream()
+    envelope = image.envelope
+    if envelope is None:
+        # passed through
+        return HttpResponse(b''.join(chunks), mimetype)
+    if not envelope.chunks:
+        return envelope_response(envelope)
+    resp = StreamingHttpResponse(chunks, content_type=envelope.mimetype)
+    resp['Content-Length'] = envelope.size
+    resp['ETag'] = envelope.etag
+    return resp
+
+
+def stored_image_response(image, mimetype):
+    """
+    Respond with the stored copy of the image.
+    """
+    return file_response(image.store(), mimetype, settings.SIMPLETHUMB_STORAGE_URL + image.stored_name)
+
+
+def prepare_image(request, basename, encoded_spec):
+    """
+    Find the source and check and decode the spec. Returns the image, the
+    response mimetype and whether the format was negotiated. Raises Http404
+    for a missing source or a bad spec.
+    """
     try:
-        image = Image(url=basename)
+        with metrics.timer('stage.source'):
+            image = Image(url=basename)
     except OSError:
+        metrics.incr('source_missing')
         raise Http404()
 
     try:
-        spec = Spec.from_spec(
-            decode_spec(encoded_spec, image.basename, image.mtime, settings.SIMPLETHUMB_HMAC_KEY )
-        )
+        with metrics.timer('stage.spec'):
+            spec = Spec.from_spec(
+                decode_spec(encoded_spec, image.basename, image.mtime, settings.SIMPLETHUMB_HMAC_KEY )
+            )
     except ChecksumException:
+        metrics.incr('bad_spec')
         raise Http404()
 
     image.spec = spec
+    if not image.format_supported:
+        # a url made before the engine was changed
+        metrics.incr('bad_spec')
+        raise Http404()
 
-    mimetype = mimetypes.guess_type(request.path)[0]
-    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
-                              image.mtime, image.stat.st_size):
-        return HttpResponseNotModified(content_type=mimetype)
+    negotiate = spec.image_fmt == Spec.FORMAT_AUTO
+    if negotiate:
+        image.negotiate(request.META.get('HTTP_ACCEPT'))
+        mimetype = image.mimetype
+    else:
+        mimetype = mimetypes.guess_type(request.path)[0]
+    return image, mimetype, negotiate
 
-    expire_time = settings.SIMPLETHUMB_EXPIRE_HEADER
 
-    resp = HttpResponse(
-        image.render(),
-        mimetype
-    )
+def etag_matches(if_none_match, etag):
+    """
+    Whether an If-None-Match header lists etag (weak comparison, as RFC 7232
+    asks for If-None-Match).
+    """
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def not_modified_response(request, image, mimetype, negotiate):
+    """
+    A 304 response if the client's copy is still current, otherwise None.
+    If-None-Match takes precedence over If-Modified-Since.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, image.etag)
+    else:
+        not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), image.mtime)
+    if not_modified:
+        metrics.incr('not_modified')
+        return finish_response(HttpResponseNotModified(content_type=mimetype), image, negotiate)
+    return None
+
+
+def head_response(image, mimetype):
+    """
+    Headers for a HEAD request, without rendering. Content-Length is only
+    sent when it is known without rendering: for the source itself, a
+    stored thumbnail or a cached one.
+    """
+    resp = HttpResponse(content_type=mimetype)
+    if image.passthrough:
+        resp['Content-Length'] = image.stat.st_size
+    elif settings.SIMPLETHUMB_STORAGE_ROOT:
+        if os.path.exists(image.stored_path):
+            resp['Content-Length'] = os.path.getsize(image.stored_path)
+        else:
+            resp = unknown_length_response(mimetype)
+    else:
+        envelope = cached_many([image])[0] if settings.SIMPLETHUMB_CACHE_ENABLED else None
+        if envelope is not None:
+            resp = HttpResponse(content_type=envelope.mimetype)
+            resp['Content-Length'] = envelope.size
+            resp['ETag'] = envelope.etag
+        else:
+            resp = unknown_length_response(mimetype)
+    return resp
+
+
+def unknown_length_response(mimetype):
+    # a streaming response, so middleware doesn't fill in a Content-Length of 0
+    return StreamingHttpResponse([], content_type=mimetype)
+
+
+def unavailable_response():
+    resp = HttpResponse('Too many thumbnails are being rendered, try again shortly.', status=503,
+                        content_type='text/plain')
+    resp['Retry-After'] = '1'
+    return resp
+
+
+def finish_response(resp, image, negotiate):
+    expire_time = settings.SIMPLETHUMB_EXPIRE_HEADER
     resp['Expires'] = http_date(time.time() + expire_time)
     resp['Last-Modified'] = http_date(image.mtime)
-
+    if not resp.has_header('ETag'):
+        resp['ETag'] = image.etag
+    # the url changes along with the source, so what it points to never does
+    patch_cache_control(resp, public=True, max_age=expire_time, immutable=True)
+    if negotiate:
+        patch_vary_headers(resp, ['Accept'])
     return resp
+
+
+# noinspection PyUnusedLocal
+def serve_image(request, basename, encoded_spec, ext):
+    with metrics.in_progress('requests'), metrics.timer('request'):
+        return _serve_image(request, basename, encoded_spec)
+
+
+def _serve_image(request, basename, encoded_spec):
+    image, mimetype, negotiate = prepare_image(request, basename, encoded_spec)
+
+    resp = not_modified_response(request, image, mimetype, negotiate)
+    if resp is not None:
+        return resp
+
+    if request.method == 'HEAD':
+        return finish_response(head_response(image, mimetype), image, negotiate)
+
+    try:
+        if image.passthrough:
+            metrics.incr('passthrough')
+            resp = file_response(image.path, mimetype)
+        elif settings.SIMPLETHUMB_STORAGE_ROOT:
+            resp = stored_image_response(image, mimetype)
+        else:
+            resp = rendered_response(image, mimetype)
+    except RenderQueueTimeout:
+        metrics.incr('unavailable')
+        return unavailable_response()
+    return finish_response(resp, image, negotiate)
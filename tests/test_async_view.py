@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image
+
+try:
+    from django.test import AsyncClient
+except ImportError:
+    # Django < 3.1
+    AsyncClient = None
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@unittest.skipIf(AsyncClient is None, 'async views need Django 3.1')
+@override_settings(ROOT_URLCONF='simplethumb.async_urls')
+class TestAsyncView(TestCase):
+
+    def get_image(self, url, **kwargs):
+        from asgiref.sync import async_to_sync
+        with mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME)):
+            return async_to_sync(AsyncClient().get)(url, **kwargs)
+
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def test_render(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertTrue(resp.content.startswith(b'\x89PNG'))
+
+    def test_cached(self):
+        self.get_image('/cat.png.fcGFof8.png')
+        with mock.patch('simplethumb.models.Image.render') as render:
+            resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertFalse(render.called)
+        self.assertTrue(resp.content.startswith(b'\x89PNG'))
+
+    def test_not_modified(self):
+        # Django 3.x's AsyncClient takes header names as they go on the wire
+        resp = self.get_image('/cat.png.fcGFof8.png', **{'if-modified-since': 'Sat, 14 Feb 2009 00:00:00 GMT'})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_passthrough_off_loop(self):
+        on_loop = []
+
+        def passthrough(image):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return False
+
+        with mock.patch('simplethumb.models.Image.passthrough', property(passthrough)):
+            self.get_image('/cat.png.fcGFof8.png')
+            from asgiref.sync import async_to_sync
+            with mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME)):
+                resp = async_to_sync(AsyncClient().head)('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(on_loop)
+        self.assertFalse(any(on_loop))
+
+    def test_source_found_off_loop(self):
+        on_loop = []
+        find_fs_image = Image._find_fs_image
+
+        def find(image, max_age=0):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return find_fs_image(image, max_age)
+
+        with mock.patch('simplethumb.models.Image._find_fs_image', find):
+            resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(on_loop, [False])
+
+    def test_missing_source(self):
+        resp = self.get_image('/missing.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_bad_spec(self):
+        resp = self.get_image('/cat.png.xxxxxxx.png')
+        self.assertEqual(resp.status_code, 404)
+
+    @override_settings(SIMPLETHUMB_RENDER_QUEUE_SIZE=0)
+    def test_saturated(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp['Retry-After'], '1')
+
+    @override_settings(SIMPLETHUMB_RENDER_QUEUE_SIZE=0)
+    def test_saturated_serves_cached(self):
+        with override_settings(SIMPLETHUMB_RENDER_QUEUE_SIZE=1):
+            self.get_image('/cat.png.fcGFof8.png')
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 200)
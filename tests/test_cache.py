@@ -0,0 +1,197 @@
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.cache import Envelope, LocalCache, local_cache
+from simplethumb.models import Image, cached_many, image_cache
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@override_settings(SIMPLETHUMB_LOCAL_CACHE_SIZE=10, SIMPLETHUMB_LOCAL_CACHE_TTL=60)
+class TestLocalCache(TestCase):
+    def setUp(self):
+        self.cache = LocalCache()
+
+    def test_get_set(self):
+        self.cache.set('a', b'1234')
+        self.assertEqual(self.cache.get('a'), b'1234')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'size': 4})
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', b'1234')
+        self.cache.set('b', b'1234')
+        self.cache.get('a')
+        self.cache.set('c', b'1234')
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), b'1234')
+        self.assertEqual(self.cache.size, 8)
+
+    def test_too_large(self):
+        self.cache.set('a', b'12345678901')
+        self.assertEqual(self.cache.get('a'), None)
+
+    def test_expiry(self):
+        self.cache.set('a', b'1234')
+        with mock.patch('time.time', mock.MagicMock(return_value=10 ** 10)):
+            self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.size, 0)
+
+    @override_settings(SIMPLETHUMB_LOCAL_CACHE_SIZE=0)
+    def test_disabled(self):
+        self.cache.set('a', b'1234')
+        self.assertEqual(self.cache.get('a'), None)
+
+
+class TestCacheFormat(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def test_key_length(self):
+        short = Image(url='cat.png', spec='100x').cache_key
+        with mock.patch('simplethumb.models.Image.source_id', mock.PropertyMock(return_value='/a' * 200 + '/cat.png')):
+            deep = Image(url='cat.png', spec='100x').cache_key
+        self.assertEqual(len(short), len(deep))
+        self.assertNotEqual(short, deep)
+        self.assertRegex(short, r'^[a-z0-9:]+$')
+
+    def test_key_includes_mtime(self):
+        image = Image(url='cat.png', spec='100x')
+        key = image.cache_key
+        with mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME)):
+            self.assertNotEqual(image.cache_key, key)
+
+    def test_envelope(self):
+        image = Image(url='cat.png', spec='100x jpeg')
+        image_data = image.render()
+        value = image_cache.get(image.cache_key)
+        self.assertIsInstance(value, bytes)
+        envelope = Envelope.unpack(value)
+        self.assertEqual(envelope, Envelope('JPEG', 100, 150, 'image/jpeg', image.etag, len(image_data), 0,
+                                            image_data))
+        self.assertEqual(Envelope.unpack(envelope.pack()), envelope)
+
+    def test_unpack_other_values(self):
+        for value in (None, b'', b'\x89PNG\r\n\x1a\n', ('simplethumb.chunked', 1, 2), b'STE\x02\x00\x00\x00\x00'):
+            self.assertIsNone(Envelope.unpack(value), value)
+
+    def test_cached_many(self):
+        Image(url='cat.png', spec='100x').render()
+        images = [Image(url='cat.png', spec=spec) for spec in ('100x', '120x', '100x')]
+        with mock.patch.object(image_cache, 'get_many', wraps=image_cache.get_many) as get_many:
+            envelopes = cached_many(images)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertEqual(len(get_many.call_args[0][0]), 2)
+        self.assertEqual(envelopes[0], envelopes[2])
+        self.assertEqual((envelopes[0].width, envelopes[0].height), (100, 150))
+        self.assertIsNone(envelopes[1])
+
+
+@override_settings(SIMPLETHUMB_LOCAL_CACHE_SIZE=10 ** 7)
+class TestTwoTierCache(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        local_cache.clear()
+
+    def test_render_fills_local_cache(self):
+        image = Image(url='cat.png', spec='100x')
+        image_data = image.render()
+        with mock.patch('simplethumb.models.image_cache') as image_cache:
+            self.assertEqual(Image(url='cat.png', spec='100x').cached.data, image_data)
+            self.assertFalse(image_cache.get.called)
+
+
+@override_settings(SIMPLETHUMB_CHUNK_SIZE=1024)
+class TestChunkedCache(TestCase):
+    def setUp(self):
+        self.cache = caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME]
+        self.cache.clear()
+
+    def test_render_chunked(self):
+        image = Image(url='cat.png', spec='200x')
+        image_data = image.render()
+        self.assertTrue(image_data.startswith(b'\x89PNG'))
+        envelope = Envelope.unpack(self.cache.get(image.cache_key))
+        self.assertEqual(envelope.data, b'')
+        self.assertEqual(envelope.size, len(image_data))
+        count = envelope.chunks
+        self.assertEqual(count, (envelope.size + 1023) // 1024)
+        chunks = [self.cache.get('{}:{}'.format(image.cache_key, index)) for index in range(count)]
+        self.assertTrue(all(len(chunk) <= 1024 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), image_data)
+        self.assertEqual(Image(url='cat.png', spec='200x').render(), image_data)
+
+    def test_small_image_not_chunked(self):
+        image = Image(url='cat.png', spec='10x')
+        image_data = image.render()
+        self.assertEqual(Envelope.unpack(self.cache.get(image.cache_key)).data, image_data)
+
+    def test_evicted_chunk(self):
+        image = Image(url='cat.png', spec='200x')
+        image_data = image.render()
+        self.cache.delete('{}:1'.format(image.cache_key))
+        with mock.patch('simplethumb.models.Image.process_image', autospec=True,
+                        side_effect=Image.process_image) as process_image:
+            self.assertEqual(Image(url='cat.png', spec='200x').render(), image_data)
+        self.assertEqual(process_image.call_count, 1)
+        # cached whole again
+        self.assertIsNotNone(self.cache.get('{}:1'.format(image.cache_key)))
+
+    def test_render_streams_from_file(self):
+        # the cache culls the chunks as soon as they are set
+        with mock.patch.object(image_cache, 'get', return_value=None), \
+                mock.patch.object(image_cache, 'has_key', return_value=False):
+            image = Image(url='cat.png', spec='200x')
+            chunks = image.render_stream()
+            image_data = b''.join(chunks)
+        self.assertTrue(image_data.startswith(b'\x89PNG'))
+        self.assertEqual(len(image_data), image.envelope.size)
+
+    def test_chunks_fetched_lazily(self):
+        image_data = Image(url='cat.png', spec='200x').render()
+        with mock.patch.object(image_cache, 'get_many', wraps=image_cache.get_many) as get_many:
+            chunks = Image(url='cat.png', spec='200x').render_stream()
+            with mock.patch.object(image_cache, 'get', wraps=image_cache.get) as get:
+                self.assertEqual(next(chunks), image_data[:1024])
+                self.assertEqual(get.call_count, 1)
+                self.assertEqual(next(chunks), image_data[1024:2048])
+                self.assertEqual(get.call_count, 2)
+        # the envelope is looked up with get_many(), the chunks are not
+        self.assertEqual(get_many.call_count, 1)
+
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    def test_view_evicted_chunk(self):
+        image_data = Image(url='cat.png', spec='100x').render()
+        self.cache.delete('{}:0'.format(Image(url='cat.png', spec='100x').cache_key))
+        resp = self.client.get('/cat.png.fcGFof8.png')
+        content = b''.join(resp.streaming_content)
+        self.assertEqual(content, image_data)
+        self.assertEqual(int(resp['Content-Length']), len(image_data))
+
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    def test_view_streams(self):
+        resp = self.client.get('/cat.png.fcGFof8.png')
+        self.assertTrue(resp.streaming)
+        image_data = b''.join(resp.streaming_content)
+        self.assertEqual(int(resp['Content-Length']), len(image_data))
+        self.assertEqual(image_data, Image(url='cat.png', spec='100x').render())
+
+    @override_settings(SIMPLETHUMB_CACHE_ENABLED=False)
+    def test_store_encodes_to_file(self):
+        storage_root = tempfile.mkdtemp()
+        try:
+            with override_settings(SIMPLETHUMB_STORAGE_ROOT=storage_root), \
+                    mock.patch('simplethumb.models.Image.render_stream') as render_stream:
+                path = Image(url='cat.png', spec='200x').store()
+            self.assertFalse(render_stream.called)
+            with open(path, 'rb') as stored:
+                self.assertTrue(stored.read().startswith(b'\x89PNG'))
+        finally:
+            shutil.rmtree(storage_root)
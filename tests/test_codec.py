@@ -0,0 +1,116 @@
+"""
+Property tests for the spec codec, checked against the original string
+based implementation so existing urls keep decoding to the same spec.
+"""
+import binascii
+import struct
+
+from django.test import SimpleTestCase
+from hypothesis import given, strategies as st
+
+from simplethumb.spec import Spec, LittleFloat, decode_spec, encode_spec, xor_crypt_string
+
+
+def reference_pack(num):
+    num = float(num)
+    if num == 1:
+        return 32768
+    if num == 0:
+        return 0
+    integral = int(num)
+    dec = num - integral
+    int_bin = '{0:b}'.format(integral) if integral > 0 else ''
+    mantissa = int_bin
+    for idx in range(LittleFloat.MANT_BITS - len(int_bin) + 1):
+        if dec == 0:
+            break
+        next_val = float(dec * 2)
+        next_bit = int(next_val)
+        mantissa += str(next_bit)
+        dec = next_val - next_bit
+    if integral:
+        exp = len(int_bin) - 1
+        sign = '0'
+    else:
+        exp = mantissa.find('1') + 1
+        sign = '1'
+        mantissa = mantissa[exp - 1:]
+    if exp >= 2 ** LittleFloat.EXP_BITS:
+        raise ValueError
+    bin_str = sign + '{0:b}'.format(exp).zfill(LittleFloat.EXP_BITS)[:LittleFloat.EXP_BITS] \
+        + mantissa[1:].ljust(LittleFloat.MANT_BITS, '0')[:LittleFloat.MANT_BITS]
+    return int(bin_str, 2)
+
+
+def reference_unpack(packed):
+    bin_str = '{0:b}'.format(packed)[-LittleFloat.SIZE:].zfill(LittleFloat.SIZE)
+    exp = int(bin_str[1:LittleFloat.EXP_BITS + 1], 2)
+    if int(bin_str[0]):
+        exp *= -1
+    mantissa = '1' + bin_str[1 + LittleFloat.EXP_BITS:]
+    number = float()
+    for idx in range(len(mantissa)):
+        if mantissa[idx] == '1':
+            number += 2 ** (exp - idx)
+    return number
+
+
+def reference_encode(spec):
+    packed_int = 0
+    header_pos = 0
+    body_pos = Spec.HEADER_LENGTH
+    for attr, size in Spec.HEADER_FMT:
+        value = min(int(spec.flags.get(attr, 0)), 2 ** size - 1)
+        packed_int += (value << header_pos)
+        header_pos += size
+        if value and attr in Spec.ATTR_FORMATS:
+            attr_val_size = Spec.ATTR_FORMATS[attr]
+            packed_int += (min(int(spec.attrs.get(attr, 0)), 2 ** attr_val_size - 1) << body_pos)
+            body_pos += attr_val_size
+    hex_str = format(packed_int, 'x').zfill(8)
+    specbytes = binascii.unhexlify(('0' * (len(hex_str) % 2)) + hex_str)
+    return struct.pack('B', sum(bytearray(specbytes)) % 255) + specbytes
+
+
+specs = st.builds(
+    lambda flags, attrs: Spec(
+        {attr: True for attr in flags},
+        {attr: value for attr, value in attrs.items() if attr in flags}),
+    st.sets(st.sampled_from(Spec.VALID_HEADERS)),
+    st.fixed_dictionaries({attr: st.integers(0, 2 ** size) for attr, size in Spec.ATTR_FORMATS.items()}),
+)
+
+
+class TestCodec(SimpleTestCase):
+
+    @given(st.floats(min_value=0, max_value=65535, allow_nan=False))
+    def test_pack_matches_reference(self, num):
+        self.assertEqual(LittleFloat.pack(num), reference_pack(num))
+
+    @given(st.integers(0, 2 ** 16 - 1))
+    def test_unpack_matches_reference(self, packed):
+        self.assertEqual(LittleFloat.unpack(packed), reference_unpack(packed))
+
+    @given(st.floats(min_value=0.01, max_value=100))
+    def test_pack_roundtrip(self, num):
+        self.assertAlmostEqual(LittleFloat.unpack(LittleFloat.pack(num)), num, delta=max(num / 1000.0, 2 ** -12))
+
+    @given(specs)
+    def test_encode_matches_reference(self, spec):
+        self.assertEqual(spec.encode(), reference_encode(spec))
+
+    @given(specs)
+    def test_spec_roundtrip(self, spec):
+        decoded = Spec.from_spec(spec.encoded)
+        self.assertEqual(decoded.encoded, spec.encoded)
+        self.assertEqual(set(decoded.flags), set(attr for attr, value in spec.flags.items() if value))
+
+    @given(specs, st.text(min_size=1), st.integers(0, 2 ** 32))
+    def test_url_roundtrip(self, spec, basename, mtime):
+        encoded = encode_spec(spec.encoded, basename, mtime, 'TESTKEY')
+        self.assertEqual(bytes(decode_spec(encoded, basename, mtime, 'TESTKEY')), spec.encoded)
+
+    @given(st.binary(), st.binary(min_size=1))
+    def test_xor(self, data, key):
+        expected = bytearray(a ^ b for a, b in zip(bytearray(data), bytearray(key * len(data))))
+        self.assertEqual(xor_crypt_string(data, key), expected)
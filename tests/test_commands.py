@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from six import StringIO
+
+from simplethumb.management.commands.simplethumb_warm import warm as warm_source
+from simplethumb.models import Image
+
+
+class TestWarmCommand(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def warm(self, *args, **kwargs):
+        out = StringIO()
+        call_command('simplethumb_warm', *args, stdout=out, stderr=StringIO(), **kwargs)
+        return out.getvalue()
+
+    def test_warm(self):
+        output = self.warm('cat.png', spec=['100x', 'thumbnail'], processes=1)
+        self.assertIn('2 rendered, 0 skipped, 0 failed', output)
+        self.assertTrue(Image(url='cat.png', spec='100x').cached)
+        self.assertTrue(Image(url='cat.png', spec='thumbnail').cached)
+
+    def test_warm_glob(self):
+        output = self.warm('*.jpg', spec=['100x'], processes=1)
+        self.assertIn('1 rendered', output)
+        self.assertTrue(Image(url='fruits.jpg', spec='100x').cached)
+
+    def test_warm_resume(self):
+        self.warm('cat.png', spec=['100x'], processes=1)
+        output = self.warm('*', spec=['100x'], processes=1)
+        self.assertIn('1 rendered, 1 skipped', output)
+
+    def test_warm_passthrough_skipped(self):
+        output = self.warm('cat.png', spec=['original', '100x'], processes=1)
+        self.assertIn('1 rendered, 1 skipped', output)
+
+    def test_source_counted_once(self):
+        results = warm_source(('cat.png', ['100x', '120x']))
+        self.assertEqual([status for url, spec, status, size, error in results], ['rendered', 'rendered'])
+        self.assertEqual(sum(size for url, spec, status, size, error in results),
+                         Image(url='cat.png').stat.st_size)
+
+    def test_warm_media(self):
+        media_root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(media_root, 'avatars'))
+            shutil.copy(os.path.join(settings.MEDIA_ROOT, 'cat.png'), os.path.join(media_root, 'avatars'))
+            with override_settings(MEDIA_ROOT=media_root, MEDIA_URL='/media/'):
+                output = self.warm('avatars/*', spec=['100x'], processes=1)
+                self.assertIn('1 rendered, 0 skipped, 0 failed', output)
+                self.assertTrue(Image(url='/media/avatars/cat.png', spec='100x').cached)
+        finally:
+            shutil.rmtree(media_root)
+
+    def test_warm_pool(self):
+        output = self.warm('cat.png', 'fruits.jpg', spec=['50x'], processes=2)
+        self.assertIn('2 rendered', output)
+
+    def test_warm_no_sources(self):
+        with self.assertRaises(CommandError):
+            self.warm('*.gif', spec=['100x'], processes=1)
+
+    @override_settings(SIMPLETHUMB_CACHE_ENABLED=False)
+    def test_warm_nowhere_to_store(self):
+        with self.assertRaises(CommandError):
+            self.warm('cat.png', processes=1)
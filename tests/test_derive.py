@@ -0,0 +1,89 @@
+import io
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.cache import Envelope
+from simplethumb.models import Image
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@override_settings(SIMPLETHUMB_DERIVE=True)
+class TestDerive(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def render(self, spec, image_name='cat.png'):
+        image = Image(url=image_name, spec=spec)
+        image_data = image.render()
+        return image, PILImage.open(io.BytesIO(image_data))
+
+    def assert_derived(self, spec, derived=True):
+        with mock.patch('simplethumb.engines.PilEngine.open', wraps=Image(url='cat.png').engine.open) as engine_open:
+            image, rendered = self.render(spec)
+        self.assertEqual(image.derived, derived)
+        self.assertEqual(engine_open.called, not derived)
+        return rendered
+
+    def test_derive_from_png(self):
+        self.render('400x')
+        rendered = self.assert_derived('100x')
+        self.assertEqual(rendered.size, (100, 150))
+        self.assertEqual(rendered.format, 'PNG')
+
+    def test_derived_matches_direct(self):
+        self.render('400x')
+        for spec in ('80x80,C', 'C16:9 100x', '10%', 'x60 jpg'):
+            derived = self.assert_derived(spec)
+            with override_settings(SIMPLETHUMB_DERIVE=False):
+                caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+                image, direct = self.render(spec)
+            self.render('400x')
+            # resampling twice may round differently by a pixel
+            self.assertAlmostEqual(derived.size[0], direct.size[0], delta=1, msg=spec)
+            self.assertAlmostEqual(derived.size[1], direct.size[1], delta=1, msg=spec)
+
+    def test_smallest_large_enough(self):
+        self.render('400x')
+        self.render('250x')
+        self.render('150x')
+        with mock.patch('simplethumb.engines.PilEngine.open_buffer',
+                        wraps=Image(url='cat.png').engine.open_buffer) as open_buffer:
+            self.render('100x')
+        self.assertEqual(PILImage.open(io.BytesIO(open_buffer.call_args[0][0])).size[0], 250)
+
+    def test_not_from_too_small(self):
+        self.render('150x')
+        self.assert_derived('100x', derived=False)
+
+    def test_quality_guard(self):
+        self.render('400x jpg')
+        self.assert_derived('100x', derived=False)
+        self.render('400x jpg90')
+        self.assert_derived('120x')
+
+    def test_not_from_crops(self):
+        self.render('400x400,C')
+        self.render('C1:1 400x')
+        self.assert_derived('100x', derived=False)
+
+    def test_disabled(self):
+        self.render('400x')
+        with override_settings(SIMPLETHUMB_DERIVE=False):
+            self.assert_derived('100x', derived=False)
+
+    @override_settings(SIMPLETHUMB_CHUNK_SIZE=64 * 1024)
+    def test_evicted_chunk(self):
+        large, rendered = self.render('400x')
+        cache = caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME]
+        self.assertGreater(Envelope.unpack(cache.get(large.cache_key)).chunks, 1)
+        cache.delete('{}:1'.format(large.cache_key))
+        rendered = self.assert_derived('100x', derived=False)
+        self.assertEqual(rendered.size, (100, 150))
+        self.assertNotIn(large.cache_key, [r[0] for r in cache.get(large._renditions_key)])
@@ -0,0 +1,61 @@
+import io
+import unittest
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.engines import pyvips
+from simplethumb.models import Image
+
+
+@unittest.skipIf(pyvips is None, 'pyvips is not installed')
+@override_settings(SIMPLETHUMB_ENGINE='simplethumb.engines.VipsEngine')
+class TestVipsEngine(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def render_image(self, spec, image_name='cat.png'):
+        image = Image(url=image_name, spec=spec)
+        image_data = image.render()
+        return PILImage.open(io.BytesIO(image_data))
+
+    def test_resize_width_height(self):
+        image = self.render_image('100x100')
+        self.assertEqual(image.size, (67, 100))
+
+    def test_square_crop(self):
+        image = self.render_image('100x C1:1')
+        self.assertEqual(image.size, (100, 100))
+
+    def test_image_scale(self):
+        image = self.render_image('200%')
+        self.assertEqual(image.size, (980, 1466))
+
+    def test_draft_jpeg(self):
+        image = self.render_image('64x', 'fruits.jpg')
+        self.assertEqual(image.size, (64, 64))
+        self.assertEqual(image.format, 'JPEG')
+
+    def test_image_format_jpeg(self):
+        image = self.render_image('jpeg80')
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.mode, 'RGB')
+
+    def test_image_format_avif(self):
+        image = Image(url='cat.png', spec='100x avif')
+        if not image.engine.can_save('AVIF'):
+            self.skipTest('libvips was built without AVIF support')
+        self.assertEqual(image.render()[4:12], b'ftypavif')
+
+    def test_metadata(self):
+        metadata = Image(url='fruits.jpg').metadata
+        self.assertEqual((metadata['width'], metadata['height']), (512, 512))
+        self.assertEqual(metadata['format'], 'JPEG')
+        self.assertEqual(metadata['mode'], 'RGB')
+
+    def test_render_many(self):
+        rendered = Image(url='fruits.jpg').render_many(['64x', '100x100,C png'])
+        sizes = [PILImage.open(io.BytesIO(image_data)).size for image_data in rendered]
+        self.assertEqual(sizes, [(64, 64), (100, 100)])
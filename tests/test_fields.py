@@ -0,0 +1,109 @@
+import shutil
+import tempfile
+import unittest
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.db import connection, models
+from django.test import TestCase, override_settings
+
+from simplethumb.fields import SimplethumbImageField, get_upload_renderer
+from simplethumb.models import Image
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class Photo(models.Model):
+    image = SimplethumbImageField(upload_to='uploads', specs=['100x', 'thumbnail'])
+
+    class Meta:
+        app_label = 'tests'
+
+
+@unittest.skipIf(not hasattr(TestCase, 'captureOnCommitCallbacks'), 'captureOnCommitCallbacks needs Django 3.2')
+@override_settings(SIMPLETHUMB_UPLOAD_RENDERER='simplethumb.fields.SyncRenderer', MEDIA_URL='/media/')
+class TestSimplethumbImageField(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(Photo)
+        super(TestSimplethumbImageField, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(TestSimplethumbImageField, cls).tearDownClass()
+        with connection.schema_editor() as schema_editor:
+            schema_editor.delete_model(Photo)
+
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        self.media_root = tempfile.mkdtemp()
+        media_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        with open(Image(url='cat.png').path, 'rb') as source:
+            self.source_data = source.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, photo=None):
+        photo = photo or Photo()
+        with self.captureOnCommitCallbacks(execute=True):
+            photo.image.save('cat.png', ContentFile(self.source_data))
+        return photo
+
+    def assert_cached(self, photo, cached=True):
+        for spec in ('100x', 'thumbnail'):
+            self.assertEqual(bool(Image(url=photo.image.url, spec=spec).cached), cached, spec)
+
+    def test_renders_on_upload(self):
+        photo = self.upload()
+        self.assert_cached(photo)
+
+    def test_waits_for_commit(self):
+        with mock.patch('simplethumb.fields.render_upload') as render_upload:
+            with self.captureOnCommitCallbacks() as callbacks:
+                photo = Photo()
+                photo.image.save('cat.png', ContentFile(self.source_data))
+            self.assertFalse(render_upload.called)
+            for callback in callbacks:
+                callback()
+        render_upload.assert_called_once_with(photo.image.url, ['100x', 'thumbnail'])
+
+    def test_unchanged_file_not_rendered(self):
+        photo = self.upload()
+        photo = Photo.objects.get(pk=photo.pk)
+        with mock.patch('simplethumb.fields.render_upload') as render_upload:
+            with self.captureOnCommitCallbacks(execute=True):
+                photo.save()
+        self.assertFalse(render_upload.called)
+
+    def test_replaced_file_rendered(self):
+        photo = Photo.objects.get(pk=self.upload().pk)
+        with mock.patch('simplethumb.fields.render_upload') as render_upload:
+            self.upload(photo)
+        render_upload.assert_called_once_with(photo.image.url, ['100x', 'thumbnail'])
+
+    def test_errors_logged(self):
+        with mock.patch('simplethumb.models.Image.render_many', side_effect=IOError('broken')), \
+                self.assertLogs('simplethumb', 'ERROR'):
+            self.upload()
+
+    @override_settings(SIMPLETHUMB_UPLOAD_RENDERER='simplethumb.fields.ThreadRenderer')
+    def test_thread_renderer(self):
+        photo = self.upload()
+        renderer = get_upload_renderer()
+        # wait for the render, and start a new pool for the next test
+        renderer.executor.shutdown(wait=True)
+        renderer._executor = None
+        self.assert_cached(photo)
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = Photo._meta.get_field('image').deconstruct()
+        self.assertEqual(path, 'simplethumb.fields.SimplethumbImageField')
+        self.assertEqual(kwargs['specs'], ['100x', 'thumbnail'])
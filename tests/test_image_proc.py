@@ -1,12 +1,21 @@
 import io
+import os
+import shutil
+import tempfile
+import unittest
 
-from PIL import Image as PILImage
+from PIL import Image as PILImage, features
 from django.conf import settings
 from django.core.cache import caches
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from simplethumb.models import Image
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 
 class TestImageProcessing(TestCase):
     def setUp(self):
@@ -46,9 +55,115 @@ class TestImageProcessing(TestCase):
         image = self.render_image('png', 'fruits.jpg')
         self.assertEqual(image.format, 'PNG')
 
+    def test_image_format_webp(self):
+        image = self.render_image('100x webp80')
+        self.assertEqual(image.format, 'WEBP')
+        self.assertEqual(image.size[0], 100)
+
+    def test_image_format_auto(self):
+        image = Image(url='cat.png', spec='auto')
+        image.negotiate('image/avif;q=0, image/webp, */*')
+        self.assertEqual(image.ext, 'webp')
+        self.assertEqual(image.mimetype, 'image/webp')
+        self.assertEqual(PILImage.open(io.BytesIO(image.render())).format, 'WEBP')
+
+    def test_image_format_auto_fallback(self):
+        image = Image(url='cat.png', spec='auto')
+        image.negotiate('image/png,*/*')
+        self.assertEqual(image.ext, 'png')
+        self.assertEqual(PILImage.open(io.BytesIO(image.render())).format, 'PNG')
+
     def test_image_scale(self):
         image = self.render_image('200%')
         self.assertEqual(image.size, (980, 1466))
 
-
-
+    def test_draft_jpeg(self):
+        image = Image(url='fruits.jpg', spec='64x')
+        image.process_image()
+        self.assertEqual(image.source_size, (512, 512))
+        self.assertEqual(image.draft_scale, 0.25)
+        self.assertEqual(image.engine.size(image.im), (64, 64))
+
+    def test_draft_matches_full_decode(self):
+        drafted = self.render_image('64x', 'fruits.jpg').convert('RGB')
+        with override_settings(SIMPLETHUMB_REDUCING_GAP=None):
+            caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+            full = self.render_image('64x', 'fruits.jpg').convert('RGB')
+        self.assertEqual(drafted.size, full.size)
+        diff = [abs(a - b) for pa, pb in zip(drafted.getdata(), full.getdata()) for a, b in zip(pa, pb)]
+        self.assertLess(float(sum(diff)) / len(diff), 4)
+
+    @unittest.skipUnless(features.check('jpg_2000'), 'Pillow was built without JPEG2000 support')
+    def test_draft_jpeg2000(self):
+        media_root = tempfile.mkdtemp()
+        try:
+            with open(Image(url='cat.png').path, 'rb') as source:
+                cat = PILImage.open(source).convert('RGB')
+                # 490x733 doesn't divide by the reduction, 488x732 does
+                cat.save(os.path.join(media_root, 'odd.jp2'))
+                cat.crop((0, 0, 488, 732)).save(os.path.join(media_root, 'even.jp2'))
+            with override_settings(MEDIA_ROOT=media_root):
+                for name, size, draft_scale in (('odd.jp2', (60, 90), 1.0), ('even.jp2', (60, 90), 0.25)):
+                    image = Image(url=name, spec='60x')
+                    self.assertEqual(PILImage.open(io.BytesIO(image.render())).size, size, name)
+                    self.assertEqual(image.draft_scale, draft_scale, name)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+    def test_draft_scale(self):
+        image = self.render_image('25%', 'fruits.jpg')
+        self.assertEqual(image.size, (128, 128))
+
+    def test_metadata(self):
+        metadata = Image(url='cat.png').metadata
+        self.assertEqual(metadata, {
+            'width': 490,
+            'height': 733,
+            'mode': 'RGB',
+            'format': 'PNG',
+            'orientation': 1,
+            'icc': False,
+        })
+        self.assertEqual(Image(url='fruits.jpg').dimensions, (512, 512))
+
+    def test_metadata_cached(self):
+        Image(url='cat.png').metadata
+        with mock.patch('simplethumb.engines.PilEngine.metadata') as metadata:
+            self.assertEqual(Image(url='cat.png').dimensions, (490, 733))
+            self.assertFalse(metadata.called)
+
+    def test_metadata_follows_mtime(self):
+        Image(url='cat.png').metadata
+        with mock.patch('simplethumb.models.Image.mtime', new_callable=mock.PropertyMock) as mtime:
+            mtime.return_value = 1
+            with mock.patch('simplethumb.engines.PilEngine.metadata') as metadata:
+                metadata.return_value = {'width': 1, 'height': 2}
+                self.assertEqual(Image(url='cat.png').dimensions, (1, 2))
+
+    def test_output_size(self):
+        for spec in ('100x', 'x100', '100x100', '100x C1:1', 'x100 C15:10', '80x80,C', '200%', '33%',
+                     'C16:9 1200x', ''):
+            caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+            self.assertEqual(Image(url='cat.png', spec=spec).output_size, self.render_image(spec).size, spec)
+
+    def test_passthrough(self):
+        for spec, passthrough in (('', True), ('800x800', True), ('png', True), ('pngO', False), ('jpeg', False),
+                                  ('100x', False), ('100%', True), ('C1:1', False), ('1000x1000,C', True)):
+            self.assertEqual(Image(url='cat.png', spec=spec).passthrough, passthrough, spec)
+        self.assertFalse(Image(url='fruits.jpg', spec='jpeg80').passthrough)
+        self.assertTrue(Image(url='fruits.jpg', spec='jpg').passthrough)
+
+    def test_no_passthrough_when_rotated(self):
+        media_root = tempfile.mkdtemp()
+        try:
+            with open(Image(url='fruits.jpg').path, 'rb') as source:
+                fruits = PILImage.open(source)
+                exif = PILImage.Exif()
+                exif[0x0112] = 6
+                fruits.save(os.path.join(media_root, 'rotated.jpg'), exif=exif)
+            with override_settings(MEDIA_ROOT=media_root):
+                image = Image(url='rotated.jpg', spec='')
+                self.assertEqual(image.metadata['orientation'], 6)
+                self.assertFalse(image.passthrough)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase
+
+from simplethumb.cache import Envelope
+from simplethumb.locks import single_flight, cache_lease
+from simplethumb.models import Image
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.cache = caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME]
+        self.cache.clear()
+
+    def test_single_flight_shares_result(self):
+        calls = []
+        results = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.2)
+            return b'data'
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight('key', slow, 5)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b'data'] * 5)
+
+    def test_cache_lease(self):
+        with cache_lease(self.cache, 'key', 5) as acquired:
+            self.assertTrue(acquired)
+            with cache_lease(self.cache, 'key', 5) as acquired_again:
+                self.assertFalse(acquired_again)
+        with cache_lease(self.cache, 'key', 5) as acquired:
+            self.assertTrue(acquired)
+
+    def test_render_waits_for_lease_holder(self):
+        image = Image(url='cat.png', spec='100x')
+        self.cache.add('lease:{}'.format(image.cache_key), 1, 5)
+        self.cache.set(image.cache_key, Envelope('PNG', 100, 150, 'image/png', image.etag, 18, 0,
+                                                 b'rendered elsewhere').pack())
+        with mock.patch.object(Image, 'cached', mock.PropertyMock(return_value=None)):
+            self.assertEqual(image.render(), b'rendered elsewhere')
+
+    def test_concurrent_renders(self):
+        original = Image.process_image
+        calls = []
+
+        def counting_process_image(image):
+            calls.append(1)
+            time.sleep(0.2)
+            original(image)
+
+        results = []
+        with mock.patch.object(Image, 'process_image', counting_process_image):
+            threads = [threading.Thread(target=lambda: results.append(Image(url='cat.png', spec='100x').render()))
+                       for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(results)), 1)
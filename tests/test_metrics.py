@@ -0,0 +1,75 @@
+import unittest
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb import metrics
+from simplethumb.models import Image
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+@override_settings(SIMPLETHUMB_METRICS_BACKEND='simplethumb.metrics.SignalSink')
+class TestMetrics(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        self.received = []
+        metrics.metric.connect(self.receive)
+
+    def tearDown(self):
+        metrics.metric.disconnect(self.receive)
+
+    def receive(self, sender, kind, name, value, **kwargs):
+        self.received.append((kind, name, value))
+
+    def names(self, kind):
+        return [name for metric_kind, name, value in self.received if metric_kind == kind]
+
+    def test_render(self):
+        Image(url='cat.png', spec='100x jpg').render()
+        self.assertEqual(self.names('incr'), ['cache.miss'])
+        self.assertEqual(
+            self.names('timing'),
+            ['stage.open', 'stage.width', 'stage.image_fmt', 'stage.encode', 'render', 'stage.cache_set'])
+        self.assertEqual(self.names('observe'), ['source_size', 'output_size'])
+        self.assertEqual([value for kind, name, value in self.received if name == 'renders'], [1, 0])
+
+        self.received = []
+        Image(url='cat.png', spec='100x jpg').render()
+        self.assertEqual(self.names('incr'), ['cache.hit'])
+
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    def test_view(self):
+        self.client.get('/cat.png.fcGFof8.png')
+        timings = self.names('timing')
+        self.assertEqual(timings[:2], ['stage.source', 'stage.spec'])
+        self.assertEqual(timings[-1], 'request')
+        self.client.get('/cat.png.xxxxxxx.png')
+        self.assertIn('bad_spec', self.names('incr'))
+
+    def test_disabled(self):
+        with override_settings(SIMPLETHUMB_METRICS_BACKEND=None):
+            Image(url='cat.png', spec='100x').render()
+        self.assertEqual(self.received, [])
+
+    @unittest.skipIf(prometheus_client is None, 'prometheus_client is not installed')
+    def test_prometheus(self):
+        sink = metrics.PrometheusSink()
+        sink.incr('test.counter', 2)
+        sink.timing('test.timing', 0.5)
+        sink.observe('test.size', 2048)
+        sink.gauge('test.gauge', 3)
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('simplethumb_test_counter_total'), 2)
+        self.assertEqual(registry.get_sample_value('simplethumb_test_timing_seconds_sum'), 0.5)
+        self.assertEqual(registry.get_sample_value('simplethumb_test_size_bytes_sum'), 2048)
+        self.assertEqual(registry.get_sample_value('simplethumb_test_gauge'), 3)
@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image
+from simplethumb.spec import Spec
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+traces = []
+
+
+def collect(trace):
+    traces.append(trace)
+
+
+@override_settings(SIMPLETHUMB_RENDER_TRACE_HOOK='tests.test_profiling.collect')
+class TestProfiling(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        del traces[:]
+
+    def test_trace(self):
+        Image(url='cat.png', spec='100x jpg').render()
+        trace, = traces
+        self.assertTrue(trace['path'].endswith('cat.png'))
+        self.assertEqual((trace['width'], trace['height'], trace['mode'], trace['format']), (490, 733, 'RGB', 'PNG'))
+        self.assertEqual(trace['spec'], {'width': 100, 'image_fmt': Spec.FORMAT_JPEG})
+        self.assertEqual([name for name, seconds in trace['stages']],
+                         ['stage.open', 'stage.width', 'stage.image_fmt', 'stage.encode', 'render'])
+        self.assertEqual(trace['estimated_memory'], 490 * 733 * 3)
+        self.assertIsNone(trace['peak_python_memory'])
+
+    def test_no_trace_when_cached(self):
+        Image(url='cat.png', spec='100x').render()
+        Image(url='cat.png', spec='100x').render()
+        self.assertEqual(len(traces), 1)
+
+    @override_settings(SIMPLETHUMB_RENDER_TRACE_HOOK=None, SIMPLETHUMB_SLOW_RENDER_THRESHOLD=0)
+    def test_slow_render_logged(self):
+        with mock.patch('simplethumb.profiling.logger') as logger:
+            Image(url='cat.png', spec='100x').render()
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(logger.warning.call_args[1]['extra']['trace']['width'], 490)
+
+    @override_settings(SIMPLETHUMB_RENDER_TRACE_HOOK=None, SIMPLETHUMB_SLOW_RENDER_THRESHOLD=60)
+    def test_fast_render_not_logged(self):
+        with mock.patch('simplethumb.profiling.logger') as logger:
+            Image(url='cat.png', spec='100x').render()
+        self.assertFalse(logger.warning.called)
+
+    @unittest.skipIf(sys.version_info < (3, 4), 'tracemalloc needs python 3.4')
+    @override_settings(SIMPLETHUMB_TRACE_MEMORY=True)
+    def test_trace_memory(self):
+        Image(url='cat.png', spec='100x').render()
+        self.assertGreater(traces[0]['peak_python_memory'], 0)
+
+    @unittest.skipIf(sys.version_info < (3, 4), 'tracemalloc needs python 3.4')
+    @override_settings(SIMPLETHUMB_TRACE_MEMORY=True)
+    def test_trace_memory_overlapping(self):
+        import tracemalloc
+        from simplethumb.profiling import trace_render
+        first_in, second_in, first_out, second_out = [threading.Event() for _ in range(4)]
+
+        def render(wait_for, started, release):
+            wait_for.wait(5)
+            with trace_render(Image(url='cat.png', spec='100x')):
+                data = bytearray(100000)
+                started.set()
+                release.wait(5)
+                del data
+
+        started = threading.Event()
+        started.set()
+        first = threading.Thread(target=render, args=(started, first_in, first_out))
+        second = threading.Thread(target=render, args=(first_in, second_in, second_out))
+        first.start()
+        second.start()
+        second_in.wait(5)
+        # the first render to start finishes first
+        first_out.set()
+        first.join()
+        self.assertTrue(tracemalloc.is_tracing())
+        second_out.set()
+        second.join()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(len(traces), 2)
+        self.assertTrue(all(trace['peak_python_memory'] >= 100000 for trace in traces))
+
+    def test_profile(self):
+        profile_dir = tempfile.mkdtemp()
+        try:
+            with override_settings(SIMPLETHUMB_PROFILE_SAMPLE_RATE=1, SIMPLETHUMB_PROFILE_DIR=profile_dir):
+                Image(url='cat.png', spec='100x').render()
+            self.assertEqual(os.listdir(profile_dir), [os.path.basename(traces[0]['profile'])])
+        finally:
+            shutil.rmtree(profile_dir)
+
+    @override_settings(SIMPLETHUMB_RENDER_TRACE_HOOK=None)
+    def test_disabled(self):
+        with mock.patch('simplethumb.metrics.record_timings') as record_timings:
+            Image(url='cat.png', spec='100x').render()
+        self.assertFalse(record_timings.called)
@@ -0,0 +1,68 @@
+import io
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image, image_cache
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class TestRenderMany(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def test_matches_render(self):
+        specs = ['100x', '50x50,C', 'C16:9 200x', '10%']
+        rendered = Image(url='cat.png').render_many(specs)
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        for spec, image_data in zip(specs, rendered):
+            self.assertEqual(image_data, Image(url='cat.png', spec=spec).render(), spec)
+
+    def test_decodes_once(self):
+        image = Image(url='fruits.jpg')
+        with mock.patch('simplethumb.engines.PilEngine.open', wraps=image.engine.open) as engine_open:
+            rendered = image.render_many(['50x', '60x', 'x100 png'])
+        self.assertEqual(engine_open.call_count, 1)
+        sizes = [PILImage.open(io.BytesIO(image_data)).size for image_data in rendered]
+        self.assertEqual(sizes, [(50, 50), (60, 60), (100, 100)])
+        # drafted for the largest of them
+        self.assertEqual(image.source_size, (512, 512))
+        self.assertEqual(image.draft_scale, 0.5)
+
+    def test_cached_with_one_set_many(self):
+        specs = ['100x', '80x80,C']
+        with mock.patch.object(image_cache, 'set_many', wraps=image_cache.set_many) as set_many:
+            Image(url='cat.png').render_many(specs)
+        self.assertEqual(set_many.call_count, 1)
+        for spec in specs:
+            self.assertTrue(Image(url='cat.png', spec=spec).cached, spec)
+
+    def test_skips_cached(self):
+        Image(url='cat.png', spec='100x').render()
+        with mock.patch.object(image_cache, 'set_many', wraps=image_cache.set_many) as set_many:
+            rendered = Image(url='cat.png').render_many(['100x', '120x', '120x'])
+        self.assertEqual(list(set_many.call_args[0][0]), [Image(url='cat.png', spec='120x').cache_key])
+        self.assertEqual(rendered[0], Image(url='cat.png', spec='100x').cached.data)
+        self.assertEqual(rendered[1], rendered[2])
+
+    def test_passthrough(self):
+        with open(Image(url='cat.png').path, 'rb') as source:
+            self.assertEqual(Image(url='cat.png').render_many(['']), [source.read()])
+
+    @override_settings(SIMPLETHUMB_CHUNK_SIZE=1024)
+    def test_chunked(self):
+        image_data, = Image(url='cat.png').render_many(['200x'])
+        image = Image(url='cat.png', spec='200x')
+        self.assertTrue(image.cached.chunks)
+        self.assertEqual(image.render(), image_data)
+
+    @override_settings(SIMPLETHUMB_CACHE_ENABLED=False)
+    def test_cache_disabled(self):
+        image_data, = Image(url='cat.png').render_many(['100x'])
+        self.assertEqual(PILImage.open(io.BytesIO(image_data)).size, (100, 150))
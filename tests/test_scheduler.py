@@ -0,0 +1,100 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image
+from simplethumb.scheduler import RenderScheduler, RenderQueueTimeout
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@override_settings(SIMPLETHUMB_RENDER_MEMORY=100, SIMPLETHUMB_RENDER_QUEUE_TIMEOUT=5)
+class TestRenderScheduler(TestCase):
+    def setUp(self):
+        self.scheduler = RenderScheduler()
+
+    def wait_for_queue(self, depth):
+        for _ in range(500):
+            if self.scheduler.queue_depth == depth:
+                return
+            time.sleep(0.01)
+        self.fail('queue never reached {}'.format(depth))
+
+    def test_within_budget(self):
+        with self.scheduler.slot(40):
+            with self.scheduler.slot(60):
+                self.assertEqual(self.scheduler.stats()['memory'], 100)
+                self.assertEqual(self.scheduler.running, 2)
+        self.assertEqual(self.scheduler.stats()['memory'], 0)
+        self.assertEqual(self.scheduler.admitted, 2)
+
+    def test_oversized_runs_alone(self):
+        with self.scheduler.slot(500):
+            self.assertEqual(self.scheduler.running, 1)
+
+    @override_settings(SIMPLETHUMB_RENDER_QUEUE_TIMEOUT=0.1)
+    def test_timeout(self):
+        with self.scheduler.slot(80):
+            with self.assertRaises(RenderQueueTimeout):
+                with self.scheduler.slot(30):
+                    pass
+        self.assertEqual(self.scheduler.timeouts, 1)
+        self.assertEqual(self.scheduler.queue_depth, 0)
+
+    def test_smallest_first(self):
+        order = []
+        release = threading.Event()
+
+        def hold():
+            with self.scheduler.slot(100):
+                release.wait()
+
+        def render(cost):
+            with self.scheduler.slot(cost):
+                order.append(cost)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        threads = []
+        for depth, cost in enumerate((90, 50, 10), 1):
+            thread = threading.Thread(target=render, args=(cost,))
+            thread.start()
+            threads.append(thread)
+            self.wait_for_queue(depth)
+        release.set()
+        for thread in [holder] + threads:
+            thread.join()
+        self.assertEqual(order, [10, 50, 90])
+        self.assertGreater(self.scheduler.wait_max, 0)
+
+    def test_disabled(self):
+        with override_settings(SIMPLETHUMB_RENDER_MEMORY=0):
+            with self.scheduler.slot(10 ** 12):
+                self.assertEqual(self.scheduler.running, 0)
+
+
+class TestRenderAdmission(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+
+    def test_memory_cost(self):
+        self.assertEqual(Image(url='cat.png').memory_cost, 490 * 733 * 3)
+
+    @override_settings(SIMPLETHUMB_RENDER_MEMORY=1)
+    def test_render_takes_slot(self):
+        with mock.patch('simplethumb.scheduler.RenderScheduler.slot') as slot:
+            Image(url='cat.png', spec='100x').render()
+        slot.assert_called_once_with(490 * 733 * 3)
+
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    def test_view_unavailable(self):
+        with mock.patch('simplethumb.scheduler.RenderScheduler.slot', side_effect=RenderQueueTimeout):
+            resp = self.client.get('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp['Retry-After'], '1')
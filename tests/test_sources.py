@@ -0,0 +1,152 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image, _source_memo
+from simplethumb.sources import SourceFileCache
+from simplethumb.templatetags.simplethumb_tags import simplethumb
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+MEDIA = os.path.join(settings.BASE_DIR, 'tests', 'media')
+
+
+class CountingStorage(FileSystemStorage):
+    """
+    A stand-in for a remote storage that counts how often files are read
+    and asked about.
+    """
+    location = None
+    opened = []
+    calls = []
+
+    def __init__(self):
+        super(CountingStorage, self).__init__(location=CountingStorage.location)
+
+    def _open(self, name, mode='rb'):
+        CountingStorage.opened.append(name)
+        return super(CountingStorage, self)._open(name, mode)
+
+    def exists(self, name):
+        CountingStorage.calls.append('exists')
+        return super(CountingStorage, self).exists(name)
+
+    def get_modified_time(self, name):
+        CountingStorage.calls.append('get_modified_time')
+        return super(CountingStorage, self).get_modified_time(name)
+
+    def size(self, name):
+        CountingStorage.calls.append('size')
+        return super(CountingStorage, self).size(name)
+
+
+class TestStorageSources(TestCase):
+    def setUp(self):
+        caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
+        # every test copies the source afresh, with a new mtime
+        _source_memo.clear()
+        self.storage_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.storage_dir, 'uploads'))
+        shutil.copy(os.path.join(MEDIA, 'cat.png'), os.path.join(self.storage_dir, 'uploads', 'photo.png'))
+        CountingStorage.location = self.storage_dir
+        del CountingStorage.opened[:]
+        del CountingStorage.calls[:]
+        self.settings_override = override_settings(
+            SIMPLETHUMB_SOURCE_STORAGE='tests.test_sources.CountingStorage',
+            SIMPLETHUMB_SOURCE_CACHE_DIR=self.cache_dir)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.storage_dir)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_render_from_storage(self):
+        image = Image(url='uploads/photo.png', spec='100x')
+        self.assertEqual(image.stat.st_size, os.path.getsize(os.path.join(MEDIA, 'cat.png')))
+        self.assertEqual(image.storage_name, 'uploads/photo.png')
+        self.assertEqual(image.render()[:4], b'\x89PNG')
+        self.assertTrue(image.path.startswith(self.cache_dir))
+
+    def test_fetched_once(self):
+        for spec in ('100x', '200x', 'x50 jpg'):
+            Image(url='uploads/photo.png', spec=spec).render()
+        self.assertEqual(CountingStorage.opened, ['uploads/photo.png'])
+
+    def test_changed_source_fetched_again(self):
+        Image(url='uploads/photo.png', spec='100x').render()
+        later = time.time() + 100
+        os.utime(os.path.join(self.storage_dir, 'uploads', 'photo.png'), (later, later))
+        Image(url='uploads/photo.png', spec='100x').render()
+        self.assertEqual(len(CountingStorage.opened), 2)
+
+    def test_metadata_without_fetch(self):
+        Image(url='uploads/photo.png').metadata
+        shutil.rmtree(self.cache_dir)
+        del CountingStorage.opened[:]
+        self.assertEqual(Image(url='uploads/photo.png').dimensions, (490, 733))
+        self.assertEqual(CountingStorage.opened, [])
+
+    def test_stat_calls(self):
+        Image(url='uploads/photo.png')
+        self.assertEqual(CountingStorage.calls, ['get_modified_time', 'size'])
+
+    def test_missing(self):
+        with self.assertRaises(OSError):
+            Image(url='uploads/missing.png')
+        self.assertEqual(CountingStorage.calls, ['get_modified_time', 'exists'])
+
+    def test_static_files_first(self):
+        image = Image(url='cat.png')
+        self.assertIsNone(image.storage_name)
+        self.assertEqual(image.path, os.path.join(MEDIA, 'cat.png'))
+
+    def test_view(self):
+        url = simplethumb('uploads/photo.png', '100x')
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content[:4], b'\x89PNG')
+
+    def test_image_field_file(self):
+        from django.db.models.fields.files import ImageFieldFile
+        field_file = mock.Mock(spec=ImageFieldFile)
+        field_file.name = 'uploads/photo.png'
+        self.assertEqual(simplethumb(field_file, '100x'), simplethumb('uploads/photo.png', '100x'))
+
+
+class TestSourceFileCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=MEDIA)
+        self.cache = SourceFileCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_evicts_least_recently_used(self):
+        size = os.path.getsize(os.path.join(MEDIA, 'cat.png'))
+        with override_settings(SIMPLETHUMB_SOURCE_CACHE_DIR=self.cache_dir, SIMPLETHUMB_SOURCE_CACHE_SIZE=size * 2):
+            first = self.cache.fetch(self.storage, 'cat.png', 1)
+            os.utime(first, (0, 0))
+            second = self.cache.fetch(self.storage, 'cat.png', 2)
+            os.utime(second, (10, 10))
+            self.cache.fetch(self.storage, 'cat.png', 1)
+            third = self.cache.fetch(self.storage, 'cat.png', 3)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(os.path.basename(path) for path in (first, third)))
+        self.assertEqual((self.cache.fetches, self.cache.hits), (3, 1))
+
+    def test_keeps_oversized_source(self):
+        with override_settings(SIMPLETHUMB_SOURCE_CACHE_DIR=self.cache_dir, SIMPLETHUMB_SOURCE_CACHE_SIZE=1):
+            path = self.cache.fetch(self.storage, 'cat.png', 1)
+        self.assertTrue(os.path.exists(path))
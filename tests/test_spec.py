@@ -6,6 +6,11 @@ from pprint import pprint
 
 from simplethumb.spec import Spec, encode_spec, decode_spec
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 
 class TestFixtures(object):
     base_name = 'foo.jpg'
@@ -32,6 +37,9 @@ class TestFixtures(object):
         ('50%', 'bqcRMa0', {'scale': True}, {'scale': 50}),
         ('png', 'e6cRAo8', {'image_fmt': True}, {'image_fmt': 1}),
         ('jpg', 'eKcRAY8', {'image_fmt': True}, {'image_fmt': 2}),
+        ('webp', 'eacRAI8', {'image_fmt': True}, {'image_fmt': 3}),
+        ('avif', 'fqcRB48', {'image_fmt': True}, {'image_fmt': 4}),
+        ('auto', 'f6cRBo8', {'image_fmt': True}, {'image_fmt': 5}),
     ]
 
     @classmethod
@@ -97,3 +105,23 @@ class TestSpec(TestCase):
     pass
 
 TestFixtures.test_factory()
+
+
+class TestSpecParser(TestCase):
+    def test_unknown_token(self):
+        with mock.patch('simplethumb.spec.logger') as logger:
+            spec = Spec.from_string('100x bogus')
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(spec.attrs, {'width': 100})
+
+    def test_token_order(self):
+        # tokens apply in TOKEN_SPEC order regardless of where they appear in the string
+        spec = Spec.from_string('200x 100x50')
+        self.assertEqual(spec.attrs, {'width': 200, 'height': 50})
+
+    def test_multiple_tokens(self):
+        spec = Spec.from_string('C16:9 300x200,C jpeg80')
+        self.assertEqual(spec.flags, {'crop_ratio': True, 'crop': True, 'width': True, 'height': True,
+                                      'image_fmt': True, 'formatarg': True})
+        self.assertEqual(spec.image_fmt, Spec.FORMAT_JPEG)
+        self.assertEqual(spec.formatarg, '80')
@@ -1,9 +1,14 @@
 import os
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.db.models.fields.files import ImageFieldFile, FileField
 from django.template import Template, Context
-from django.test import TestCase
+from django.test import TestCase, override_settings
+
+from simplethumb.models import Image
+from simplethumb.spec import spec_signature
+from simplethumb.templatetags.simplethumb_tags import simplethumb, simplethumb_srcset
 
 try:
     from unittest import mock
@@ -28,3 +33,59 @@ class TestTemplateTag(TestCase):
         rendered = self.TEMPLATE.render(Context({'image': image, 'spec': ''}))
 
         self.assertEqual(rendered, '/cat.png.EcGFxfc.png')
+
+    def test_template_tag_memoized(self):
+        context = Context({'image': 'cat.png', 'spec': '100x'})
+        rendered = self.TEMPLATE.render(context)
+        with mock.patch('simplethumb.models.os.stat') as stat, \
+                mock.patch('simplethumb.templatetags.simplethumb_tags.encode_spec') as encode:
+            self.assertEqual(self.TEMPLATE.render(context), rendered)
+        self.assertFalse(stat.called)
+        self.assertFalse(encode.called)
+
+    @override_settings(SIMPLETHUMB_SOURCE_CACHE_TIMEOUT=0)
+    def test_template_tag_revalidate(self):
+        context = Context({'image': 'cat.png', 'spec': '100x'})
+        self.TEMPLATE.render(context)
+        with mock.patch('simplethumb.models.os.stat', wraps=os.stat) as stat:
+            self.TEMPLATE.render(context)
+        self.assertTrue(stat.called)
+
+    def test_template_tag_unsupported_format(self):
+        image = Image(url='cat.png')
+        with mock.patch.object(type(image.engine), 'can_save', return_value=False):
+            with self.assertRaises(ImproperlyConfigured):
+                simplethumb('cat.png', '100x avif')
+            # 'auto' falls back to the source format instead
+            self.assertTrue(simplethumb('cat.png', '100x auto').endswith('.png'))
+
+    def test_srcset(self):
+        template = Template('{% load simplethumb_tags %}{% simplethumb_srcset image "200x 100x 800x" "jpg" %}')
+        rendered = template.render(Context({'image': 'cat.png'}))
+        candidates = [candidate.split(' ') for candidate in rendered.split(', ')]
+        self.assertEqual([width for url, width in candidates], ['100w', '200w', '490w'])
+        self.assertEqual(candidates[0][0], simplethumb('cat.png', '100x jpg'))
+        self.assertTrue(candidates[2][0].endswith('.jpg'))
+
+    def test_srcset_rendered_widths(self):
+        # fruits.jpg is 512x512, so a 1:2 crop is at most 256 wide
+        rendered = simplethumb_srcset('fruits.jpg', '200x 300x 400x', 'C1:2')
+        candidates = [candidate.split(' ') for candidate in rendered.split(', ')]
+        self.assertEqual([width for url, width in candidates], ['200w', '256w'])
+        self.assertEqual(candidates[1][0], simplethumb('fruits.jpg', '300x C1:2'))
+        # cat.png is 490x733, so 300 high is about 200 wide
+        rendered = simplethumb_srcset('cat.png', '100x 250x', 'x300')
+        self.assertEqual([candidate.split(' ')[1] for candidate in rendered.split(', ')], ['100w', '201w'])
+
+    def test_srcset_signs_once(self):
+        with mock.patch('simplethumb.templatetags.simplethumb_tags.spec_signature',
+                        wraps=spec_signature) as signature, \
+                mock.patch('simplethumb.spec.spec_signature', wraps=spec_signature) as encode_signature:
+            simplethumb_srcset('cat.png', '110x 120x 130x')
+        self.assertEqual(signature.call_count, 1)
+        self.assertFalse(encode_signature.called)
+
+    def test_size(self):
+        template = Template('{% load simplethumb_tags %}{% simplethumb_size image "100x" as size %}'
+                            '{{ size.0 }}x{{ size.1 }}')
+        self.assertEqual(template.render(Context({'image': 'cat.png'})), '100x150')
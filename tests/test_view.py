@@ -1,8 +1,15 @@
+import os
+import shutil
+import tempfile
+
 from django.conf import settings
 from django.core.cache import caches
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.http import http_date
 
+from simplethumb.models import Image
+from simplethumb.templatetags.simplethumb_tags import simplethumb
+
 try:
     from unittest import mock
 except ImportError:
@@ -15,6 +22,11 @@ class TestView(TestCase):
     def get_image(self, url, kwargs={}):
         return self.client.get(url, **kwargs)
 
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    @mock.patch('time.time', mock.MagicMock(return_value=0))
+    def get_head(self, url):
+        return self.client.head(url)
+
     def setUp(self):
         caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].clear()
 
@@ -44,3 +56,124 @@ class TestView(TestCase):
     def test_view_status_badimage(self):
         resp = self.get_image('/dog.png.xxxxxxx.png')
         self.assertEqual(resp.status_code, 404)
+
+    @mock.patch('simplethumb.models.Image.mtime', mock.PropertyMock(return_value=settings.FAKE_TIME))
+    def test_view_unsupported_format(self):
+        engine = type(Image(url='cat.png').engine)
+        with mock.patch.object(engine, 'can_save', return_value=True):
+            url = simplethumb('cat.png', '100x avif')
+        with mock.patch.object(engine, 'can_save', return_value=False):
+            resp = self.get_image(url)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_view_auto_format(self):
+        resp = self.get_image('/cat.png.NMGFwNc.png', {'HTTP_ACCEPT': 'image/webp,*/*'})
+        self.assertEqual(resp['Content-Type'], 'image/webp')
+        self.assertEqual(resp['Vary'], 'Accept')
+        resp = self.get_image('/cat.png.NMGFwNc.png', {'HTTP_ACCEPT': '*/*'})
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertEqual(resp['Vary'], 'Accept')
+
+    def test_view_passthrough(self):
+        with mock.patch('simplethumb.engines.PilEngine.save_to') as save:
+            resp = self.get_image('/cat.png.EcGFxfc.png')
+        self.assertFalse(save.called)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        with open(os.path.join(settings.BASE_DIR, 'tests', 'media', 'cat.png'), 'rb') as source:
+            self.assertEqual(b''.join(resp.streaming_content), source.read())
+        resp.close()
+        self.assertIsNone(caches[settings.SIMPLETHUMB_CACHE_BACKEND_NAME].get(Image(url='cat.png', spec='').cache_key))
+
+    @override_settings(SIMPLETHUMB_PASSTHROUGH=False)
+    def test_view_passthrough_disabled(self):
+        with mock.patch('simplethumb.engines.PilEngine.save_to') as save:
+            resp = self.get_image('/cat.png.EcGFxfc.png')
+        self.assertTrue(save.called)
+        resp.close()
+
+    def test_view_etag(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        etag = resp['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertEqual(self.get_image('/cat.png.fcGFof8.png')['ETag'], etag)
+        self.assertNotEqual(self.get_image('/cat.png.EcGFxfc.png')['ETag'], etag)
+
+    def test_view_cache_control(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(
+            sorted(resp['Cache-Control'].split(', ')),
+            sorted(['public', 'max-age={}'.format(settings.SIMPLETHUMB_EXPIRE_HEADER), 'immutable']))
+
+    def test_view_if_none_match(self):
+        etag = self.get_image('/cat.png.fcGFof8.png')['ETag']
+        with mock.patch('simplethumb.models.Image.render') as render, \
+                mock.patch('simplethumb.models.Image.cached', new_callable=mock.PropertyMock) as cached:
+            resp = self.get_image('/cat.png.fcGFof8.png', {'HTTP_IF_NONE_MATCH': '"other", W/' + etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp['ETag'], etag)
+        self.assertFalse(render.called)
+        self.assertFalse(cached.called)
+
+    def test_view_if_none_match_changed(self):
+        resp = self.get_image('/cat.png.fcGFof8.png', {
+            'HTTP_IF_NONE_MATCH': '"other"',
+            'HTTP_IF_MODIFIED_SINCE': http_date(settings.FAKE_TIME),
+        })
+        self.assertEqual(resp.status_code, 200)
+
+    def test_view_head(self):
+        with mock.patch('simplethumb.models.Image.render') as render:
+            resp = self.get_head('/cat.png.fcGFof8.png')
+        self.assertFalse(render.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertIn('ETag', resp)
+
+    @override_settings(MIDDLEWARE=['django.middleware.common.CommonMiddleware'])
+    def test_view_head_content_length(self):
+        # not rendered yet, so the length isn't known
+        resp = self.get_head('/cat.png.fcGFof8.png')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Length', resp)
+
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        content = b''.join(resp.streaming_content) if resp.streaming else resp.content
+        resp = self.get_head('/cat.png.fcGFof8.png')
+        self.assertEqual(int(resp['Content-Length']), len(content))
+
+    def test_view_head_passthrough(self):
+        resp = self.get_head('/cat.png.EcGFxfc.png')
+        self.assertEqual(int(resp['Content-Length']),
+                         os.path.getsize(os.path.join(settings.BASE_DIR, 'tests', 'media', 'cat.png')))
+
+
+class TestStoredView(TestView):
+
+    def setUp(self):
+        super(TestStoredView, self).setUp()
+        self.storage_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(SIMPLETHUMB_STORAGE_ROOT=self.storage_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.storage_root)
+
+    def test_view_stored_file(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertEqual(resp['Content-Type'], 'image/png')
+        self.assertTrue(b''.join(resp.streaming_content).startswith(b'\x89PNG'))
+        resp.close()
+        stored = [files for _, _, files in os.walk(self.storage_root) if files]
+        self.assertEqual(len(stored), 1)
+
+    @override_settings(SIMPLETHUMB_SENDFILE_BACKEND='x-accel-redirect')
+    def test_view_x_accel_redirect(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertTrue(resp['X-Accel-Redirect'].startswith(settings.SIMPLETHUMB_STORAGE_URL))
+        self.assertEqual(resp.content, b'')
+
+    @override_settings(SIMPLETHUMB_SENDFILE_BACKEND='x-sendfile')
+    def test_view_x_sendfile(self):
+        resp = self.get_image('/cat.png.fcGFof8.png')
+        self.assertTrue(os.path.isfile(resp['X-Sendfile']))